@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compare per-id and pipelined interests lookups against a local Redis.
+
+    python -m benchmarks.bench_interests --ids 500 --repeat 20
+"""
+
+import statistics
+import time
+from optparse import OptionParser
+
+from scoring_api import api
+from scoring_api import scoring
+from scoring_api.store import Store
+
+KEY_PREFIX = "bench:interests:"
+
+
+def populate(store, client_ids):
+    for cid in client_ids:
+        store.set_list(KEY_PREFIX + str(cid), ["Sport", "Books", "Travel"])
+
+
+def per_id(store, keys):
+    return [scoring.get_interests(store, key) for key in keys]
+
+
+def pipelined(store, keys):
+    return scoring.get_interests_bulk(store, keys)
+
+
+def measure(fn, store, keys, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(store, keys)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--ids", action="store", type=int, default=500)
+    op.add_option("-r", "--repeat", action="store", type=int, default=20)
+    (opts, args) = op.parse_args()
+
+    store = Store(api.REDIS_CONFIG, api.REDIS_CUSTOM_CONFIG)
+    client_ids = range(opts.ids)
+    keys = [KEY_PREFIX + str(cid) for cid in client_ids]
+    populate(store, client_ids)
+
+    assert per_id(store, keys) == pipelined(store, keys)
+    for name, fn in (("per-id", per_id), ("pipelined", pipelined)):
+        timings = measure(fn, store, keys, opts.repeat)
+        print("%-10s ids=%d median=%.2fms min=%.2fms max=%.2fms"
+              % (name, opts.ids, statistics.median(timings),
+                 min(timings), max(timings)))
+
+    store.redis_client.delete(*keys)
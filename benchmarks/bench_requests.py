@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time request construction and validation.
+
+    python -m benchmarks.bench_requests --number 20000
+"""
+
+import timeit
+from optparse import OptionParser
+
+from scoring_api import api
+
+ONLINE_SCORE = {
+    "account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "token",
+    "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "a",
+                  "last_name": "b", "birthday": "01.01.1990", "gender": 1},
+}
+CLIENTS_INTERESTS = {
+    "account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "token": "token",
+    "arguments": {"client_ids": [1, 2, 3, 4], "date": "19.07.2017"},
+}
+
+CASES = [
+    ("OnlineScoreRequest()", lambda: api.OnlineScoreRequest(ONLINE_SCORE)),
+    ("OnlineScoreRequest.isvalid", lambda: api.OnlineScoreRequest(ONLINE_SCORE).isvalid()),
+    ("ClientsInterestsRequest()", lambda: api.ClientsInterestsRequest(CLIENTS_INTERESTS)),
+    ("ClientsInterestsRequest.isvalid", lambda: api.ClientsInterestsRequest(CLIENTS_INTERESTS).isvalid()),
+]
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=20000)
+    op.add_option("-r", "--repeat", action="store", type=int, default=5)
+    (opts, args) = op.parse_args()
+
+    for name, fn in CASES:
+        best = min(timeit.repeat(fn, number=opts.number, repeat=opts.repeat))
+        print("%-32s %8.2f us/op" % (name, best / opts.number * 1e6))
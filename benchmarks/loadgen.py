@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Replay a corpus of requests against a running server.
+
+    python -m benchmarks.loadgen corpus.jsonl --concurrency 16 --duration 30
+    python -m benchmarks.loadgen api.log --rate 500 --duration 60 --json
+
+The corpus is read line by line and may mix:
+  * method requests, one JSON object per line (posted to /method/),
+  * batches, one JSON array per line (posted to /batch/),
+  * {"path": ..., "body": ...} objects,
+  * request log lines written by the server, plain or --log-format json.
+
+Without --rate the run is closed-loop: every connection sends its next
+request as soon as the previous one is answered. With --rate requests are
+started on a fixed schedule whether or not earlier ones finished, and
+latency is measured from the scheduled start, so a stalled server shows up
+as latency instead of as a lower request rate.
+"""
+
+import ast
+import datetime
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.client import HTTPConnection, HTTPException
+from optparse import OptionParser
+
+from scoring_api import api
+
+PERCENTILES = (50, 95, 99, 99.9)
+# "<path>: b'<body>' <request id>", the request line of logs.log_request
+LOG_REQUEST_RE = re.compile(r"(/\S*): (b(['\"]).*\3) \S+$")
+
+
+def parse_log_message(message):
+    match = LOG_REQUEST_RE.search(message)
+    if match is None:
+        return None
+    try:
+        body = json.loads(ast.literal_eval(match.group(2)))
+    except (ValueError, SyntaxError):
+        return None
+    return match.group(1), body
+
+
+def parse_line(line):
+    # (path, body) of a corpus line, or None if it isn't a request
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return parse_log_message(line)
+    if isinstance(entry, list):
+        return "/batch/", entry
+    if not isinstance(entry, dict):
+        return None
+    if "path" in entry and "body" in entry:
+        # a request line of a JSON log, unless its body was cut short
+        if not isinstance(entry["body"], (dict, list)):
+            return None
+        return entry["path"], entry["body"]
+    if "method" in entry:
+        return "/method/", entry
+    return None
+
+
+def load_corpus(lines):
+    corpus, skipped = [], 0
+    for line in lines:
+        request = parse_line(line)
+        if request is None:
+            skipped += 1
+        else:
+            corpus.append(request)
+    return corpus, skipped
+
+
+def sign(request, now=None):
+    # the token check_auth expects for the request's account and login
+    if not isinstance(request, dict):
+        return request
+    request = dict(request)
+    if request.get("login") == api.ADMIN_LOGIN:
+        request["token"] = api.admin_digest(now or datetime.datetime.now())
+    else:
+        request["token"] = api.user_digest(str(request.get("account") or ""), str(request.get("login") or ""))
+    return request
+
+
+def sign_corpus(corpus, now=None):
+    signed = []
+    for path, body in corpus:
+        if isinstance(body, list):
+            body = [sign(item, now) for item in body]
+        else:
+            body = sign(body, now)
+        signed.append((path, json.dumps(body).encode()))
+    return signed
+
+
+def percentile(ordered, p):
+    # nearest-rank percentile of a sorted list
+    if not ordered:
+        return 0.0
+    rank = max(1, int(-(-p * len(ordered) // 100)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Results(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.codes = Counter()
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add(self, code, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.codes[code] += 1
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        ordered = sorted(self.latencies)
+        return {
+            "requests": len(ordered),
+            "duration": elapsed,
+            "throughput": len(ordered) / elapsed if elapsed else 0.0,
+            "latency_ms": dict(("p%s" % p, percentile(ordered, p) * 1000) for p in PERCENTILES),
+            "codes": dict((str(code), count) for code, count in sorted(self.codes.items(), key=str)),
+        }
+
+
+class Client(object):
+    # one keep-alive connection, reopened after errors
+
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+
+    def post(self, path, body):
+        if self.connection is None:
+            self.connection = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request("POST", path, body, {"Content-Type": "application/json"})
+            response = self.connection.getresponse()
+            response.read()
+            if response.will_close:
+                self.close()
+            return response.status
+        except (OSError, HTTPException):
+            self.close()
+            return "error"
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def run_closed(corpus, host, port, concurrency, duration=0, total=0, timeout=10):
+    requests = itertools.cycle(corpus)
+    lock = threading.Lock()
+    sent = itertools.count()
+    results = Results()
+    deadline = results.started + duration if duration else None
+
+    def worker():
+        client = Client(host, port, timeout)
+        while True:
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+            if total and next(sent) >= total:
+                break
+            with lock:
+                path, body = next(requests)
+            started = time.perf_counter()
+            code = client.post(path, body)
+            results.add(code, time.perf_counter() - started)
+        client.close()
+
+    run_workers(worker, concurrency)
+    results.finished = time.perf_counter()
+    return results
+
+
+def run_open(corpus, host, port, concurrency, rate, duration=0, total=0, timeout=10):
+    if not total:
+        total = int(rate * duration)
+    lock = threading.Lock()
+    scheduled = itertools.count()
+    results = Results()
+
+    def worker():
+        # workers take requests in start order, work out when each one is
+        # due from its index and sleep until then
+        client = Client(host, port, timeout)
+        while True:
+            with lock:
+                i = next(scheduled)
+            if i >= total:
+                break
+            path, body = corpus[i % len(corpus)]
+            start_at = results.started + i / rate
+            delay = start_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            code = client.post(path, body)
+            results.add(code, time.perf_counter() - start_at)
+        client.close()
+
+    run_workers(worker, concurrency)
+    results.finished = time.perf_counter()
+    return results
+
+
+def run_workers(worker, concurrency):
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def format_report(report):
+    lines = [
+        "requests    %d in %.2fs" % (report["requests"], report["duration"]),
+        "throughput  %.1f req/s" % report["throughput"],
+        "latency     " + "  ".join("%s %.2fms" % item for item in report["latency_ms"].items()),
+        "codes       " + "  ".join("%s: %d" % item for item in report["codes"].items()),
+    ]
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] CORPUS...")
+    op.add_option("-H", "--host", action="store", default="localhost")
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-d", "--duration", action="store", type=float, default=10)
+    op.add_option("-n", "--requests", action="store", type=int, default=0)
+    op.add_option("-r", "--rate", action="store", type=float, default=0)
+    op.add_option("--timeout", action="store", type=float, default=10)
+    op.add_option("--keep-tokens", action="store_true", default=False)
+    op.add_option("--json", action="store_true", default=False)
+    (opts, args) = op.parse_args()
+    if not args:
+        op.error("no corpus given")
+
+    corpus, skipped = [], 0
+    for filename in args:
+        with open(filename) as f:
+            requests, not_requests = load_corpus(f)
+        corpus.extend(requests)
+        skipped += not_requests
+    if not corpus:
+        op.error("no requests found in the corpus")
+    if opts.keep_tokens:
+        corpus = [(path, json.dumps(body).encode()) for path, body in corpus]
+    else:
+        corpus = sign_corpus(corpus)
+    print("replaying %d requests (%d lines skipped)" % (len(corpus), skipped), file=sys.stderr)
+
+    duration = 0 if opts.requests else opts.duration
+    if opts.rate:
+        results = run_open(corpus, opts.host, opts.port, opts.concurrency, opts.rate, duration, opts.requests,
+                           opts.timeout)
+    else:
+        results = run_closed(corpus, opts.host, opts.port, opts.concurrency, duration, opts.requests,
+                             opts.timeout)
+    report = results.report()
+    print(json.dumps(report, indent=2) if opts.json else format_report(report))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the hot paths of the API against the in-memory store.
+
+    python -m benchmarks.suite --output baseline.json
+    python -m benchmarks.suite --baseline baseline.json --threshold 0.2
+
+With --baseline the run exits with status 1 when a benchmark got slower
+than the baseline by more than the threshold (0.2 is 20%).
+"""
+
+import datetime
+import json
+import platform
+import sys
+import timeit
+from optparse import OptionParser
+
+from benchmarks import bench_requests
+from scoring_api import api
+from scoring_api import scoring
+from scoring_api.store import MemoryStore
+
+ACCOUNT, LOGIN = "horns&hoofs", "h&f"
+ARGUMENTS = {"phone": "79175002040", "email": "stupnikov@otus.ru", "first_name": "a",
+             "last_name": "b", "birthday": "01.01.1990", "gender": 1}
+
+
+def online_score_request():
+    return {"account": ACCOUNT, "login": LOGIN, "method": "online_score",
+            "token": api.user_digest(ACCOUNT, LOGIN), "arguments": dict(ARGUMENTS)}
+
+
+def clients_interests_request(nclients):
+    return {"account": ACCOUNT, "login": LOGIN, "method": "clients_interests",
+            "token": api.user_digest(ACCOUNT, LOGIN),
+            "arguments": {"client_ids": list(range(nclients)), "date": "19.07.2017"}}
+
+
+def make_store(nclients=1000):
+    store = MemoryStore()
+    for cid in range(nclients):
+        store.set_list(cid, ["Sport", "Books", "Travel"])
+    return store
+
+
+def request_cases():
+    return list(bench_requests.CASES)
+
+
+def field_cases():
+    fields = [
+        (api.CharField(), "stupnikov"),
+        (api.ArgumentsField(), ARGUMENTS),
+        (api.EmailField(), "stupnikov@otus.ru"),
+        (api.PhoneField(), "79175002040"),
+        (api.DateField(), "19.07.2017"),
+        (api.BirthDayField(), "01.01.1990"),
+        (api.GenderField(), 1),
+        (api.ClientIDsField(), list(range(100))),
+    ]
+    return [("%s.validate" % type(field).__name__, lambda field=field, value=value: field.validate(value))
+            for field, value in fields]
+
+
+def auth_cases():
+    user = api.OnlineScoreRequest(online_score_request())
+    admin = api.OnlineScoreRequest(dict(online_score_request(), login=api.ADMIN_LOGIN,
+                                        token=api.admin_digest(datetime.datetime.now())))
+    forbidden = api.OnlineScoreRequest(dict(online_score_request(), token="0" * 128))
+    return [
+        ("check_auth user", lambda: api.check_auth(user)),
+        ("check_auth admin", lambda: api.check_auth(admin)),
+        ("check_auth forbidden", lambda: api.check_auth(forbidden)),
+    ]
+
+
+def scoring_cases():
+    store = make_store(0)
+    scoring.get_score(store, ARGUMENTS["phone"], ARGUMENTS["email"])
+
+    def cold():
+        store.items.clear()
+        return scoring.get_score(store, ARGUMENTS["phone"], ARGUMENTS["email"])
+
+    return [
+        ("get_score warm", lambda: scoring.get_score(store, ARGUMENTS["phone"], ARGUMENTS["email"])),
+        ("get_score cold", cold),
+    ]
+
+
+def handler_cases():
+    store = make_store()
+    cases = []
+    for nclients in (1, 100, 1000):
+        request = {"body": clients_interests_request(nclients)}
+        cases.append(("clients_interests_handler %d ids" % nclients,
+                      lambda request=request: api.clients_interests_handler(request, {}, store)))
+    online_score = {"body": online_score_request()}
+    clients_interests = {"body": clients_interests_request(100)}
+    cases.append(("method_handler online_score", lambda: api.method_handler(online_score, {}, store)))
+    batch = {"body": dict(online_score_request(), method="online_score_batch",
+                          arguments={"profiles": [dict(ARGUMENTS, phone="7917%07d" % i) for i in range(100)]})}
+    cases.append(("method_handler online_score_batch 100", lambda: api.method_handler(batch, {}, store)))
+    cases.append(("method_handler clients_interests", lambda: api.method_handler(clients_interests, {}, store)))
+    return cases
+
+
+def all_cases():
+    return request_cases() + field_cases() + auth_cases() + scoring_cases() + handler_cases()
+
+
+def run(cases, repeat=5, min_time=0.2):
+    results = {}
+    for name, fn in cases:
+        timer = timeit.Timer(fn)
+        number = 1
+        while timer.timeit(number) < min_time:
+            number *= 2
+        best = min(timer.repeat(repeat=repeat, number=number))
+        results[name] = {"us_per_op": best / number * 1e6, "number": number}
+    return results
+
+
+def compare(results, baseline, threshold):
+    # (name, baseline us/op, current us/op, regressed) for benchmarks in both
+    rows = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["us_per_op"], result["us_per_op"]
+        rows.append((name, before, after, after > before * (1 + threshold)))
+    return rows
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-r", "--repeat", action="store", type=int, default=5)
+    op.add_option("--min-time", action="store", type=float, default=0.2)
+    op.add_option("-k", "--filter", action="store", default=None)
+    op.add_option("-o", "--output", action="store", default=None)
+    op.add_option("-b", "--baseline", action="store", default=None)
+    op.add_option("--threshold", action="store", type=float, default=0.2)
+    (opts, args) = op.parse_args()
+
+    cases = [case for case in all_cases() if not opts.filter or opts.filter in case[0]]
+    results = run(cases, opts.repeat, opts.min_time)
+    report = {"python": platform.python_version(), "results": results}
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressed = False
+        for name, before, after, slower in compare(results, baseline, opts.threshold):
+            regressed = regressed or slower
+            print("%-36s %10.2f -> %10.2f us/op %+7.1f%%%s"
+                  % (name, before, after, (after / before - 1) * 100, "  REGRESSION" if slower else ""),
+                  file=sys.stderr)
+        sys.exit(1 if regressed else 0)
@@ -5,14 +5,27 @@ import json
 import datetime
 import logging
 import hashlib
+import hmac
 import re
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from weakref import WeakKeyDictionary
 
+from scoring_api import logs
+from scoring_api import metrics
+from scoring_api import profiling
 from scoring_api import scoring
-from scoring_api.store import Store
+from scoring_api import timing
+from scoring_api.store import STORES, Store, make_store  # noqa: F401
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -21,12 +34,16 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_TIMEOUT = 408
+REQUEST_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_TIMEOUT: "Request Timeout",
+    REQUEST_TOO_LARGE: "Payload Too Large",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
@@ -39,35 +56,106 @@ GENDERS = {
     FEMALE: "female",
 }
 MAX_AGE = 70
+MAX_BATCH_PROFILES = 1000
+MAX_BATCH_REQUESTS = 100
+MAX_CLIENT_IDS = 10000
+# request bodies larger than this are refused without being read, and a body
+# must arrive within BODY_READ_TIMEOUT seconds
+MAX_BODY_SIZE = 1024 * 1024
+BODY_READ_TIMEOUT = 5
+READ_CHUNK_SIZE = 64 * 1024
+KEEPALIVE_TIMEOUT = 5
+MAX_KEEPALIVE_REQUESTS = 100
+# how often an idle keep-alive connection checks whether a new connection
+# waits for its worker thread
+IDLE_POLL_INTERVAL = 0.05
+# worker threads per process in threaded and prefork mode
+THREADS = 8
+# a prefork worker that exited is replaced after this many seconds, so one
+# that cannot start doesn't spin the master
+RESPAWN_DELAY = 1.0
+AUTH_CACHE_SIZE = 1024
+# the previous hour's admin token is still accepted this many seconds
+# into the new hour
+ADMIN_TOKEN_GRACE = 60
+# clients_interests answers requests with this header with a chunked stream,
+# fetching INTERESTS_CHUNK_SIZE ids per pipeline
+STREAM_HEADER = "X-Stream"
+INTERESTS_CHUNK_SIZE = 500
 
 STORE = None
+PROFILER = None
+REQUESTS = metrics.REGISTRY.counter(
+    "scoring_requests_total", "Requests by method and status code",
+    ("method", "code"))
+REQUEST_LATENCY = metrics.REGISTRY.histogram(
+    "scoring_request_duration_seconds", "Request latency",
+    ("method", "code"))
+IN_FLIGHT = metrics.REGISTRY.gauge(
+    "scoring_requests_in_flight", "Requests being handled")
+metrics.REGISTRY.callback_gauge(
+    "scoring_store_pool_connections", "Redis pool connections by state",
+    ("state",), lambda: store_pool_connections())
 REDIS_CONFIG = {
     "host": 'localhost',
     "port": 6379,
     "db": 0,
     "socket_timeout": 3,
     "socket_connect_timeout": 3,
+    "socket_keepalive": True,
+    "health_check_interval": 30,
+    "max_connections": 50,
 }
 REDIS_CUSTOM_CONFIG = {
-    "reconnect_attempts": 5
+    "reconnect_attempts": 5,
+    # jittered exponential backoff between attempts, bounded per call
+    "retry_base_delay": 0.05,
+    "retry_max_delay": 1.0,
+    "retry_deadline": 2.0,
+    # fail fast after this many consecutive errors, probe again after timeout
+    "breaker_failure_threshold": 5,
+    "breaker_reset_timeout": 5.0,
+    # wait up to pool_timeout seconds for a free connection instead of
+    # failing once max_connections are checked out
+    "blocking_pool": True,
+    "pool_timeout": 2,
+    # entries kept in the in-process score cache (--local-cache-size), 0
+    # disables it: a worker may serve a score up to its ttl after another
+    # process rewrote it
+    "local_cache_size": 0,
+    # queue score cache writes and flush them in pipelined batches
+    # (--write-behind); queued writes are lost if the process dies
+    "write_behind": False,
+    "write_behind_size": 10000,
+    # seconds to collect the interests lookups of concurrent requests into
+    # one pipelined fetch (up to batch_max_size keys), 0 fetches right away
+    "batch_window": 0,
+    "batch_max_size": 500,
+    # interests lists kept in process until a keyspace notification reports
+    # a write to the key, or for interests_cache_ttl seconds should one be
+    # lost (--interests-cache-size); 0 disables it
+    "interests_cache_size": 0,
+    "interests_cache_ttl": 300,
+    # the cache stays off unless notify-keyspace-events has K and A; let it
+    # run CONFIG SET to add them, or trust they are set where CONFIG is off
+    "interests_cache_configure": False,
+    "interests_cache_notifications": False,
 }
 
 
+EMAIL_RE = re.compile(r'[^@]+@[^@]+\.[^@]+')
+PHONE_RE = re.compile(r'^7[0-9]{10}$')
+DATE_FORMAT = "%d.%m.%Y"
+
+
 class BaseField:
     def __init__(self, required=False, nullable=False):
         self.required = required
         self.nullable = nullable
-        self.data = WeakKeyDictionary()
 
     def __set_name__(self, owner, name):
         self.name = name
 
-    def __set__(self, instance, value):
-        self.data[instance] = value
-
-    def __get__(self, instance, owner):
-        return self.data.get(instance)
-
     def validate(self, value):
         if self.required and value is None:
             return ValueError(f'The field {type(self).__name__} is required')
@@ -98,7 +186,7 @@ class EmailField(CharField):
     def validate(self, value):
         if not self.required and value is None:
             return True
-        if not re.match(r'[^@]+@[^@]+\.[^@]+', str(value)):
+        if not EMAIL_RE.match(str(value)):
             return ValueError('E-mail must contain @')
         return True
 
@@ -107,22 +195,27 @@ class PhoneField(BaseField):
     def validate(self, value):
         if not self.required and value is None:
             return True
-        if not re.match(r'^7[0-9]{10}$', str(value)):
+        if not PHONE_RE.match(str(value)):
             return ValueError('Phone must start with 7 and has 11 symbols')
         return True
 
 
 class DateField(CharField):
-    def validate(self, value):
-        if not self.required and value is None:
-            return True
+    def parse(self, value):
         result = super(DateField, self).validate(value)
         if result is not True:
             return result
         try:
-            datetime.datetime.strptime(value, "%d.%m.%Y")
+            return datetime.datetime.strptime(value, DATE_FORMAT)
         except ValueError:
             return ValueError('Date format must be DD.MM.YYYY')
+
+    def validate(self, value):
+        if not self.required and value is None:
+            return True
+        result = self.parse(value)
+        if isinstance(result, ValueError):
+            return result
         return True
 
 
@@ -130,10 +223,9 @@ class BirthDayField(DateField):
     def validate(self, value):
         if not self.required and value is None:
             return True
-        result = super(BirthDayField, self).validate(value)
-        if result is not True:
-            return result
-        birthday = datetime.datetime.strptime(value, "%d.%m.%Y")
+        birthday = self.parse(value)
+        if isinstance(birthday, ValueError):
+            return birthday
         if (datetime.datetime.now() - birthday).days > MAX_AGE * 365:
             return ValueError('Max age is 70 years')
         return True
@@ -143,7 +235,7 @@ class GenderField(BaseField):
     def validate(self, value):
         if not self.required and value is None:
             return True
-        if value not in GENDERS.keys():
+        if value not in GENDERS:
             return ValueError('Gender must be 0, 1 or 2')
         return True
 
@@ -156,30 +248,69 @@ class ClientIDsField(BaseField):
             return ValueError('%s is not a list' % value)
         if len(value) == 0:
             return ValueError('IDs list is empty')
+        if len(value) > MAX_CLIENT_IDS:
+            return ValueError('No more than %d IDs per request'
+                              % MAX_CLIENT_IDS)
         for item in value:
             if not isinstance(item, int):
                 return ValueError('%s is not a list of int' % value)
         return True
 
 
-class MethodRequest(object):
-    def __new__(cls, *args, **kwargs):
-        cls.fields = [k for k, v in cls.__dict__.items()
-                      if isinstance(v, BaseField)]
-        cls.request_fields = [k for k, v in MethodRequest.__dict__.items()
-                              if isinstance(v, BaseField)]
+class ProfilesField(BaseField):
+    def validate(self, value):
+        if not self.required and value is None:
+            return True
+        if not isinstance(value, list):
+            return ValueError('%s is not a list' % value)
+        if len(value) == 0:
+            return ValueError('Profiles list is empty')
+        if len(value) > MAX_BATCH_PROFILES:
+            return ValueError('No more than %d profiles per request'
+                              % MAX_BATCH_PROFILES)
+        return True
 
-        return super(MethodRequest, cls).__new__(cls)
 
+class RequestMeta(type):
+    # Turns the declared fields into a schema once per class: values live in
+    # __slots__ of the same name and validation walks precompiled
+    # (name, validate) pairs instead of looking descriptors up every time.
+    def __new__(mcs, name, bases, namespace):
+        declared = {key: value for key, value in namespace.items()
+                    if isinstance(value, BaseField)}
+        for key in declared:
+            del namespace[key]
+        namespace["__slots__"] = tuple(declared)
+        cls = super(RequestMeta, mcs).__new__(mcs, name, bases, namespace)
+        for key, field in declared.items():
+            field.__set_name__(cls, key)
+
+        if any(isinstance(base, RequestMeta) for base in bases):
+            # subclasses declare the fields of "arguments"
+            cls.schema = dict(cls.schema, **declared)
+            cls.fields = list(declared)
+        else:
+            # the root class declares the request envelope
+            cls.schema = declared
+            cls.request_fields = list(declared)
+            cls.request_validators = tuple((key, field.validate)
+                                           for key, field in declared.items())
+            cls.fields = []
+        cls.validators = tuple((key, cls.schema[key].validate)
+                               for key in cls.fields)
+        return cls
+
+
+class MethodRequest(metaclass=RequestMeta):
     def __init__(self, data, **kwargs):
         arguments = data["arguments"] if "arguments" in data else {}
+        if not isinstance(arguments, dict):
+            arguments = {}
         for field in self.fields:
-            if field in arguments:
-                setattr(self, field, arguments.get(field))
+            setattr(self, field, arguments.get(field))
 
         for field in self.request_fields:
-            if field in data:
-                setattr(self, field, data.get(field))
+            setattr(self, field, data.get(field))
 
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
@@ -193,12 +324,10 @@ class MethodRequest(object):
 
     def isvalid(self):
         errors_list = []
-        for key in self.request_fields:
-            field = MethodRequest.__dict__.get(key)
-            value = getattr(self, key)
-            result = field.validate(value)
+        for key, validate in self.request_validators:
+            result = validate(getattr(self, key))
             if result is not True:
-                errors_list.append(result)
+                errors_list.append(key + ": " + str(result))
         success = len(errors_list) == 0
         return success, errors_list
 
@@ -207,18 +336,20 @@ class ClientsInterestsRequest(MethodRequest):
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
 
+    def validate_arguments(self):
+        errors_list = []
+        for key, validate in self.validators:
+            result = validate(getattr(self, key))
+            if result is not True:
+                errors_list.append(key + ": " + str(result))
+        return errors_list
+
     def isvalid(self):
         success, errors_list = super(ClientsInterestsRequest, self).isvalid()
         if not success:
             return success, errors_list
 
-        for key in self.fields:
-            field = self.__class__.__dict__.get(key)
-            value = getattr(self, key)
-            result = field.validate(value)
-            if result is not True:
-                errors_list.append(result)
-
+        errors_list = self.validate_arguments()
         success = len(errors_list) == 0
         return success, errors_list
 
@@ -231,15 +362,10 @@ class OnlineScoreRequest(MethodRequest):
     birthday = BirthDayField(required=False, nullable=True)
     gender = GenderField(required=False, nullable=True)
 
-    def isvalid(self):
-        success, errors_list = super(OnlineScoreRequest, self).isvalid()
-        if not success:
-            return success, errors_list
-
-        for key in self.fields:
-            field = self.__class__.__dict__.get(key)
-            value = getattr(self, key)
-            result = field.validate(value)
+    def validate_arguments(self):
+        errors_list = []
+        for key, validate in self.validators:
+            result = validate(getattr(self, key))
             if result is not True:
                 result = key + ": " + str(result)
                 errors_list.append(result)
@@ -252,26 +378,107 @@ class OnlineScoreRequest(MethodRequest):
             pass
         else:
             errors_list.append("Required pairs don't exist")
+        return errors_list
+
+    def isvalid(self):
+        success, errors_list = super(OnlineScoreRequest, self).isvalid()
+        if not success:
+            return success, errors_list
+
+        errors_list = self.validate_arguments()
+        success = len(errors_list) == 0
+        return success, errors_list
+
+
+class OnlineScoreBatchRequest(MethodRequest):
+    profiles = ProfilesField(required=True)
+
+    def validate_arguments(self):
+        errors_list = []
+        for key, validate in self.validators:
+            result = validate(getattr(self, key))
+            if result is not True:
+                errors_list.append(key + ": " + str(result))
+        return errors_list
+
+    def isvalid(self):
+        success, errors_list = super(OnlineScoreBatchRequest, self).isvalid()
+        if not success:
+            return success, errors_list
 
+        errors_list = self.validate_arguments()
         success = len(errors_list) == 0
         return success, errors_list
 
 
-def check_auth(request):
+def user_digest(account, login):
+    return hashlib.sha512((account + login + SALT).encode('utf-8')).hexdigest()
+
+
+def admin_digest(moment):
+    return hashlib.sha512((moment.strftime("%Y%m%d%H")
+                           + ADMIN_SALT).encode('utf-8')).hexdigest()
+
+
+class AuthCache(object):
+    def __init__(self, max_size=AUTH_CACHE_SIZE, grace=ADMIN_TOKEN_GRACE):
+        self.max_size = max_size
+        self.grace = grace
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+        # (hour, digest of the hour, digest of the previous hour)
+        self.admin = None
+
+    def user_digest(self, account, login):
+        with self.lock:
+            digest = self.digests.get((account, login))
+            if digest is not None:
+                self.digests.move_to_end((account, login))
+                return digest
+        return user_digest(account, login)
+
+    def remember(self, account, login, digest):
+        with self.lock:
+            self.digests[(account, login)] = digest
+            while len(self.digests) > self.max_size:
+                self.digests.popitem(last=False)
+
+    def admin_digests(self, now=None):
+        now = now or datetime.datetime.now()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        admin = self.admin
+        if admin is None or admin[0] != hour:
+            previous = hour - datetime.timedelta(hours=1)
+            admin = (hour, admin_digest(hour), admin_digest(previous))
+            self.admin = admin
+        if (now - hour).total_seconds() < self.grace:
+            return admin[1], admin[2]
+        return admin[1],
+
+
+AUTH_CACHE = AuthCache()
+
+
+def check_auth(request, now=None):
+    if not isinstance(request.token, str):
+        return False
+    token = request.token.encode('utf-8')
     if request.is_admin:
-        digest = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H")
-                                 + ADMIN_SALT).encode('utf-8')).hexdigest()
-    else:
-        digest = hashlib.sha512(((request.account or '')
-                                 + (request.login or '')
-                                 + SALT).encode('utf-8')).hexdigest()
-    if digest == request.token:
+        return any(hmac.compare_digest(digest.encode('utf-8'), token)
+                   for digest in AUTH_CACHE.admin_digests(now))
+
+    account, login = request.account or '', request.login or ''
+    digest = AUTH_CACHE.user_digest(account, login)
+    if hmac.compare_digest(digest.encode('utf-8'), token):
+        # only verified pairs are cached, so random logins can't evict them
+        AUTH_CACHE.remember(account, login, digest)
         return True
     return False
 
 
-def online_score_handler(request, ctx, store):
-    req = OnlineScoreRequest(request["body"])
+def prepare_online_score(request, ctx):
+    with timing.span("validation"):
+        req = OnlineScoreRequest(request["body"])
     body = request["body"]
 
     requested_fields = body["arguments"] if "arguments" in body else {}
@@ -281,13 +488,24 @@ def online_score_handler(request, ctx, store):
 
     ctx["has"] = field
 
-    if not check_auth(req):
-        return [], FORBIDDEN
+    with timing.span("auth"):
+        authorized = check_auth(req)
+    if not authorized:
+        return req, ([], FORBIDDEN)
 
-    success, error_list = req.isvalid()
+    with timing.span("validation"):
+        success, error_list = req.isvalid()
 
     if not success:
-        return error_list, INVALID_REQUEST
+        return req, (error_list, INVALID_REQUEST)
+
+    return req, None
+
+
+def online_score_handler(request, ctx, store):
+    req, error = prepare_online_score(request, ctx)
+    if error:
+        return error
 
     if req.is_admin:
         return {"score": 42}, OK
@@ -302,108 +520,732 @@ def online_score_handler(request, ctx, store):
     return {"score": score}, OK
 
 
-def clients_interests_handler(request, ctx, store):
-    req = ClientsInterestsRequest(request["body"])
+def too_many_client_ids(body):
+    arguments = body.get("arguments")
+    client_ids = (arguments.get("client_ids")
+                  if isinstance(arguments, dict) else None)
+    return isinstance(client_ids, list) and len(client_ids) > MAX_CLIENT_IDS
+
 
-    success, errors_list = req.isvalid()
+def prepare_clients_interests(request, ctx):
+    # an oversized client_ids list is refused before the request object is
+    # built and its fields are validated
+    if too_many_client_ids(request["body"]):
+        return None, (["client_ids: No more than %d IDs per request"
+                       % MAX_CLIENT_IDS], INVALID_REQUEST)
+    with timing.span("validation"):
+        req = ClientsInterestsRequest(request["body"])
+        success, errors_list = req.isvalid()
 
     if not success:
-        return errors_list, INVALID_REQUEST
+        return req, (errors_list, INVALID_REQUEST)
+
+    ctx["nclients"] = len(req.client_ids)
+    return req, None
+
+
+class StreamingResponse(object):
+    # a response body written piece by piece as the chunks are produced
+    def __init__(self, chunks):
+        self.chunks = chunks
 
-    client_ids = request["body"]["arguments"]["client_ids"]
-    ctx["nclients"] = len(client_ids)
 
-    scores = {}
-    for client_id in client_ids:
-        scores[client_id] = scoring.get_interests(store, client_id)
+def interests_json_chunks(chunks):
+    # the JSON of build_response(scores, OK), one piece per fetched chunk
+    yield '{"response": {'
+    separator = ""
+    for pairs in chunks:
+        if pairs:
+            yield separator + ", ".join(
+                json.dumps(str(cid)) + ": " + json.dumps(interests)
+                for cid, interests in pairs)
+            separator = ", "
+    yield '}, "code": %d}' % OK
+
+
+def clients_interests_handler(request, ctx, store):
+    req, error = prepare_clients_interests(request, ctx)
+    if error:
+        return error
+
+    if ctx.get("stream"):
+        client_ids = list(dict.fromkeys(req.client_ids))
+        chunks = scoring.iter_interests(store, client_ids,
+                                        INTERESTS_CHUNK_SIZE)
+        return StreamingResponse(interests_json_chunks(chunks)), OK
+
+    interests = scoring.get_interests_bulk(store, req.client_ids)
+    scores = dict(zip(req.client_ids, interests))
 
     return scores, OK
 
 
+def prepare_online_score_batch(request, ctx):
+    with timing.span("validation"):
+        req = OnlineScoreBatchRequest(request["body"])
+
+    with timing.span("auth"):
+        authorized = check_auth(req)
+    if not authorized:
+        return req, ([], FORBIDDEN)
+
+    with timing.span("validation"):
+        success, error_list = req.isvalid()
+    if not success:
+        return req, (error_list, INVALID_REQUEST)
+
+    ctx["nprofiles"] = len(req.profiles)
+    return req, None
+
+
+def validate_profiles(req):
+    # an OnlineScoreRequest, or its errors, per item of req.profiles
+    profiles = []
+    with timing.span("validation"):
+        for arguments in req.profiles:
+            if not isinstance(arguments, dict):
+                profiles.append(["Profile must be an object"])
+                continue
+            profile = OnlineScoreRequest({"arguments": arguments})
+            errors_list = profile.validate_arguments()
+            profiles.append(errors_list or profile)
+    return profiles
+
+
+def score_columns(profiles):
+    valid = [p for p in profiles if isinstance(p, OnlineScoreRequest)]
+    return ([p.phone for p in valid], [p.email for p in valid],
+            [p.birthday for p in valid], [p.gender for p in valid],
+            [p.first_name for p in valid], [p.last_name for p in valid])
+
+
+def batch_scores_response(profiles, scores):
+    # scores come in the order of the valid profiles
+    scores = iter(scores)
+    return [build_response({"score": next(scores)}, OK)
+            if isinstance(profile, OnlineScoreRequest)
+            else build_response(profile, INVALID_REQUEST)
+            for profile in profiles]
+
+
+def online_score_batch_handler(request, ctx, store):
+    req, error = prepare_online_score_batch(request, ctx)
+    if error:
+        return error
+
+    profiles = validate_profiles(req)
+    columns = score_columns(profiles)
+    if req.is_admin:
+        scores = [42] * len(columns[0])
+    else:
+        scores = scoring.get_scores(store, *columns)
+    return batch_scores_response(profiles, scores), OK
+
+
 def method_handler(request, ctx, store):
     body = request["body"]
     if "method" in body:
         path = body["method"]
     else:
         return ["Unknown method"], INVALID_REQUEST
-    router = {
-        "online_score": online_score_handler,
-        "clients_interests": clients_interests_handler
-    }
-
-    response, code = router[path]({"body": request["body"]}, ctx, store)
+    response, code = METHOD_ROUTER[path]({"body": request["body"]}, ctx,
+                                         store)
 
     return response, code
 
 
+METHOD_ROUTER = {
+    "online_score": online_score_handler,
+    "clients_interests": clients_interests_handler,
+    "online_score_batch": online_score_batch_handler,
+}
+
+
+def metric_method(path, request):
+    # label values come from a fixed set, never from raw client input
+    if path == "method" and isinstance(request, dict):
+        method = request.get("method")
+        return method if method in METHOD_ROUTER else "unknown"
+    return path if path in MainHTTPHandler.router else "unknown"
+
+
+def record_request(path, request, code, duration):
+    method = metric_method(path, request)
+    REQUESTS.inc(method, code)
+    REQUEST_LATENCY.observe(method, code, value=duration)
+
+
+def store_pool_connections():
+    if STORE is None:
+        return {}
+    stats = STORE.pool_stats()
+    if stats is None:
+        return {}
+    return {("in_use",): stats["in_use"], ("idle",): stats["idle"]}
+
+
+def profile_handler(request, ctx, store):
+    # dumps the aggregated profiles; the request envelope must carry admin
+    # credentials
+    req = MethodRequest(request["body"])
+    if not req.is_admin or not check_auth(req):
+        return [], FORBIDDEN
+    if PROFILER is None:
+        return ["Profiling is disabled"], INVALID_REQUEST
+    return {"files": PROFILER.dump()}, OK
+
+
+def dump_profiles(signum, frame):
+    # pstats does file I/O, keep it out of the signal handler
+    def dump():
+        for path in PROFILER.dump():
+            logging.info("Profile written to %s", path)
+
+    threading.Thread(target=dump, name="profile-dump", daemon=True).start()
+
+
+def build_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"),
+            "code": code}
+
+
+def check_batch(body):
+    if not isinstance(body, list):
+        return ["Batch must be a list of method requests"], INVALID_REQUEST
+    if not body:
+        return ["Batch is empty"], INVALID_REQUEST
+    if len(body) > MAX_BATCH_REQUESTS:
+        return (["No more than %d requests per batch" % MAX_BATCH_REQUESTS],
+                INVALID_REQUEST)
+    return None
+
+
+def prepare_batch_item(item, ctx):
+    # (req, None) for a request answered together with the rest of the
+    # batch, (None, (response, code)) when it is already answered, or
+    # (None, None) when it goes through method_handler on its own
+    if not isinstance(item, dict):
+        return None, (["Method request must be an object"], INVALID_REQUEST)
+    method = item.get("method")
+    if method == "online_score":
+        req, error = prepare_online_score({"body": item}, ctx)
+        if error:
+            return None, error
+        if req.is_admin:
+            return None, ({"score": 42}, OK)
+        return req, None
+    if method == "clients_interests":
+        req, error = prepare_clients_interests({"body": item}, ctx)
+        return (None, error) if error else (req, None)
+    return None, None
+
+
+def batch_client_ids(reqs):
+    return list(dict.fromkeys(cid for req in reqs for cid in req.client_ids))
+
+
+def batch_scores_results(scores):
+    return [({"score": score}, OK) for score in scores]
+
+
+def batch_interests_results(reqs, client_ids, interests):
+    interests = dict(zip(client_ids, interests))
+    return [(dict((cid, interests[cid]) for cid in req.client_ids), OK)
+            for req in reqs]
+
+
+def batch_scores(reqs, store):
+    return batch_scores_results(
+        scoring.get_scores(store, *score_columns(reqs)))
+
+
+def batch_interests(reqs, store):
+    client_ids = batch_client_ids(reqs)
+    return batch_interests_results(
+        reqs, client_ids, scoring.get_interests_bulk(store, client_ids))
+
+
+def batch_handler(request, ctx, store):
+    # Elements are authorized and validated one by one, then the scores of
+    # all online_score elements take one bulk cache read (and one write of
+    # the misses) and the interests of all clients_interests elements one
+    # pipelined fetch.
+    body = request["body"]
+    error = check_batch(body)
+    if error:
+        return error
+
+    ctx["nrequests"] = len(body)
+    results = [None] * len(body)
+    deferred = {OnlineScoreRequest: [], ClientsInterestsRequest: []}
+    for i, item in enumerate(body):
+        item_ctx = {"request_id": ctx["request_id"]}
+        try:
+            req, results[i] = prepare_batch_item(item, item_ctx)
+            if req is None and results[i] is None:
+                results[i] = method_handler({"body": item}, item_ctx, store)
+        except Exception as e:
+            logging.exception("Unexpected error: %s", e)
+            req, results[i] = None, (None, INTERNAL_ERROR)
+        if req is not None:
+            deferred[type(req)].append((i, req))
+
+    for request_class, answer in ((OnlineScoreRequest, batch_scores),
+                                  (ClientsInterestsRequest, batch_interests)):
+        items = deferred[request_class]
+        if not items:
+            continue
+        try:
+            answers = answer([req for _, req in items], store)
+        except Exception as e:
+            logging.exception("Unexpected error: %s", e)
+            answers = [(None, INTERNAL_ERROR)] * len(items)
+        for (i, _), result in zip(items, answers):
+            results[i] = result
+
+    return [build_response(response, code)
+            for response, code in results], OK
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
+        "profile": profile_handler,
     }
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; with Nagle on, a
+    # keep-alive client waits out its delayed ACK before it sees the body
+    disable_nagle_algorithm = True
+    # idle keep-alive connections are dropped after this many seconds
+    timeout = KEEPALIVE_TIMEOUT
+    max_body_size = MAX_BODY_SIZE
+    body_timeout = BODY_READ_TIMEOUT
+    max_keepalive_requests = MAX_KEEPALIVE_REQUESTS
+
+    def setup(self):
+        super(MainHTTPHandler, self).setup()
+        self.requests_served = 0
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def handle_one_request(self):
+        if self.requests_served and not self.wait_for_request():
+            self.close_connection = True
+            return
+        super(MainHTTPHandler, self).handle_one_request()
+
+    def wait_for_request(self):
+        # An idle keep-alive connection holds a worker thread (the only one
+        # in single mode): it is given up as soon as another connection
+        # waits for one, instead of after the whole keep-alive timeout.
+        try:
+            self.connection.settimeout(0)
+            if self.rfile.peek(1):
+                # pipelined, already buffered
+                return True
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        saturated = getattr(self.server, "saturated", None)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if saturated is None:
+                # single-threaded: a new connection shows up as a
+                # readable listening socket
+                readable = select.select([self.connection,
+                                          self.server.socket],
+                                         [], [], remaining)[0]
+                if self.connection in readable:
+                    return True
+                if readable:
+                    return False
+                continue
+            if select.select([self.connection], [], [],
+                             min(remaining, IDLE_POLL_INTERVAL))[0]:
+                return True
+            if saturated():
+                return False
+
     def do_POST(self):
-        response, code = {}, OK
+        IN_FLIGHT.inc()
+        try:
+            self.handle_post()
+        finally:
+            IN_FLIGHT.dec()
+
+    def do_GET(self):
+        self.requests_served += 1
+        if self.path.strip("/") != "metrics":
+            data = json.dumps(build_response(None, NOT_FOUND)).encode()
+            self.send_body(NOT_FOUND, data, "application/json")
+            return
+        data = metrics.REGISTRY.render().encode()
+        self.send_body(OK, data, metrics.CONTENT_TYPE)
+
+    def send_head(self, code, content_type, headers):
+        if self.requests_served >= self.max_keepalive_requests:
+            self.close_connection = True
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        for name, value in headers:
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def send_body(self, code, data, content_type, headers=()):
+        headers = [("Content-Length", str(len(data)))] + list(headers)
+        self.send_head(code, content_type, headers)
+        self.wfile.write(data)
+
+    def send_stream(self, code, chunks, content_type):
+        self.send_head(code, content_type, [("Transfer-Encoding", "chunked")])
+        try:
+            for chunk in chunks:
+                data = chunk.encode()
+                if data:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # the status is already out: cut the stream short so the client
+            # sees an incomplete body rather than a truncated JSON document
+            logging.exception("Cannot stream response: %s", e)
+            self.close_connection = True
+
+    def read_body(self):
+        # (body, OK), or (None, error code) without reading any further; a
+        # body that wasn't read to its end leaves the connection unusable
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            length = -1
+        if length < 0 or length > self.max_body_size:
+            self.close_connection = True
+            return None, BAD_REQUEST if length < 0 else REQUEST_TOO_LARGE
+
+        chunks, remaining = [], length
+        deadline = time.monotonic() + self.body_timeout
+        try:
+            while remaining:
+                # bounds the whole body, not just the wait for each packet
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError()
+                self.connection.settimeout(timeout)
+                chunk = self.rfile.read1(min(remaining, READ_CHUNK_SIZE))
+                if not chunk:
+                    self.close_connection = True
+                    return None, BAD_REQUEST
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        except TimeoutError:
+            self.close_connection = True
+            return None, REQUEST_TIMEOUT
+        finally:
+            self.connection.settimeout(self.timeout)
+        return b"".join(chunks), OK
+
+    def wants_stream(self):
+        return (STREAM_HEADER in self.headers
+                and self.request_version == "HTTP/1.1")
+
+    def handle_post(self):
+        started = time.perf_counter()
         context = {"request_id": self.get_request_id(self.headers)}
+        token = timing.start(context)
+        try:
+            self.process_post(started, context)
+        finally:
+            timing.stop(token)
+
+    def process_post(self, started, context):
+        response, code = {}, OK
         request = None
+        self.requests_served += 1
+        with timing.span("read"):
+            data_string, code = self.read_body()
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            if data_string is not None:
+                with timing.span("decode"):
+                    request = json.loads(data_string)
         except Exception:
             code = BAD_REQUEST
 
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path,
-                                        data_string,
-                                        context["request_id"]))
+        path = self.path.strip("/")
+        # an empty batch is still a batch, and gets 422
+        if request or request == []:
+            if self.wants_stream():
+                context["stream"] = True
             if path in self.router:
                 try:
-                    response, code = method_handler({"body": request},
-                                                    context,
-                                                    STORE)
+                    response, code = self.route(path, request, context)
                 except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
+                    logging.exception("Unexpected error: %s", e)
                     code = INTERNAL_ERROR
             else:
                 code = NOT_FOUND
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"),
-                 "code": code}
+        if isinstance(response, StreamingResponse):
+            context["code"] = code
+            self.send_stream(code, response.chunks, "application/json")
+            logs.log_request(self.path, data_string, context)
+            record_request(path, request, code,
+                           time.perf_counter() - started)
+            return
+
+        r = build_response(response, code)
+        with timing.span("serialize"):
+            data = json.dumps(r).encode()
+        duration = time.perf_counter() - started
         context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode())
+        logs.log_request(self.path, data_string if request else None, context)
+        record_request(path, request, code, duration)
+        headers = []
+        if timing.DEBUG_HEADER in self.headers:
+            context["timings"]["total"] = duration
+            headers.append(("Server-Timing",
+                            timing.server_timing(context["timings"])))
+        self.send_body(code, data, "application/json", headers)
         return
 
+    def route(self, path, request, context):
+        handler = self.router[path]
+        if PROFILER is None:
+            return handler({"body": request}, context, STORE)
+        return PROFILER.run(metric_method(path, request), self.headers,
+                            handler, {"body": request}, context, STORE)
+
+    def log_message(self, format, *args):
+        # access lines go through logging instead of straight to stderr
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+    def log_error(self, format, *args):
+        logging.warning("%s - " + format, self.address_string(), *args)
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    def __init__(self, server_address, handler_class, workers):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # connections accepted but not yet picked up by a worker
+        self.queued = 0
+        self.queued_lock = threading.Lock()
+        super(ThreadPoolHTTPServer, self).__init__(server_address,
+                                                   handler_class)
+
+    def saturated(self):
+        return self.queued > 0
+
+    def process_request(self, request, client_address):
+        with self.queued_lock:
+            self.queued += 1
+        self.executor.submit(self.process_request_thread,
+                             request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        with self.queued_lock:
+            self.queued -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super(ThreadPoolHTTPServer, self).server_close()
+        self.executor.shutdown(wait=True)
+
+
+class ReusePortMixin:
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(ReusePortMixin, self).server_bind()
+
+
+class ReusePortHTTPServer(ReusePortMixin, HTTPServer):
+    pass
+
+
+class ReusePortThreadPoolHTTPServer(ReusePortMixin, ThreadPoolHTTPServer):
+    pass
+
+
+def make_server(address, threads, reuse_port=False):
+    if threads > 1:
+        server_class = (ReusePortThreadPoolHTTPServer if reuse_port
+                        else ThreadPoolHTTPServer)
+        return server_class(address, MainHTTPHandler, threads)
+    server_class = ReusePortHTTPServer if reuse_port else HTTPServer
+    return server_class(address, MainHTTPHandler)
 
-if __name__ == "__main__":
-    op = OptionParser()
-    op.add_option("-p", "--port", action="store", type=int, default=8080)
-    op.add_option("-l", "--log", action="store", default=None)
-    (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log,
-                        level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s',
-                        datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
 
-    STORE = Store(REDIS_CONFIG, REDIS_CUSTOM_CONFIG)
+def terminate(signum, frame):
+    sys.exit(0)
 
-    STORE.set("test", "testvalue")
 
-    test_value = STORE.get("test")
+def report_pool_stats(interval):
+    def report():
+        while True:
+            time.sleep(interval)
+            if STORE is not None:
+                logging.info("Redis pool stats: %s", STORE.pool_stats())
+                logging.info("Local cache stats: %s",
+                             STORE.local_cache_stats())
+                logging.info("Write-behind stats: %s",
+                             STORE.write_behind_stats())
+                logging.info("Interests cache stats: %s",
+                             STORE.interests_cache_stats())
 
+    threading.Thread(target=report, name="pool-stats", daemon=True).start()
+
+
+def serve(server, stats_interval=0):
+    signal.signal(signal.SIGTERM, terminate)
+    if PROFILER is not None:
+        signal.signal(signal.SIGUSR1, dump_profiles)
+    if stats_interval:
+        report_pool_stats(stats_interval)
     try:
         server.serve_forever()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
         pass
-    server.server_close()
+    finally:
+        server.server_close()
+        if STORE is not None:
+            logging.info("Redis pool stats: %s", STORE.pool_stats())
+            STORE.close()
+        logs.stop_logging()
+
+
+def run_prefork(address, workers, threads, stats_interval=0,
+                store="redis"):
+    children = []
+    stopping = False
+    signals = {signal.SIGTERM, signal.SIGINT, signal.SIGUSR1}
+
+    def spawn():
+        global STORE
+        # a worker must not run the master's handlers, so signals wait
+        # until it has its own
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, terminate)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            # /metrics shows the registry of whichever worker accepted the
+            # scrape, so every sample names its worker
+            metrics.REGISTRY.const_labels = (("pid", os.getpid()),)
+            # each worker binds its own socket on the shared port and owns
+            # its own Redis connections
+            STORE = make_store(store, REDIS_CONFIG, REDIS_CUSTOM_CONFIG)
+            serve(make_server(address, threads, reuse_port=True),
+                  stats_interval)
+            os._exit(0)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+        children.append(pid)
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def dump_workers(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    if PROFILER is not None:
+        signal.signal(signal.SIGUSR1, dump_workers)
+    for _ in range(workers):
+        spawn()
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        children.remove(pid)
+        if stopping:
+            continue
+        logging.warning("Worker %d exited with code %d, starting another",
+                        pid, os.waitstatus_to_exitcode(status))
+        time.sleep(RESPAWN_DELAY)
+        if not stopping:
+            spawn()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-m", "--mode", action="store", type="choice",
+                  choices=["single", "threaded", "prefork"], default="single")
+    # processes in prefork mode
+    op.add_option("-w", "--workers", action="store", type=int,
+                  default=os.cpu_count() or 1)
+    # threads per process in threaded and prefork mode
+    op.add_option("-t", "--threads", action="store", type=int,
+                  default=THREADS)
+    op.add_option("-s", "--store", action="store", type="choice",
+                  choices=sorted(STORES), default="redis")
+    op.add_option("--batch-window", action="store", type=float, default=0)
+    op.add_option("--local-cache-size", action="store", type=int, default=0)
+    op.add_option("--write-behind", action="store_true", default=False)
+    op.add_option("--interests-cache-size", action="store", type=int,
+                  default=0)
+    op.add_option("--max-body-size", action="store", type=int,
+                  default=MAX_BODY_SIZE)
+    op.add_option("--pool-stats-interval", action="store", type=int,
+                  default=0)
+    op.add_option("--log-format", action="store", type="choice",
+                  choices=["plain", "json"], default="plain")
+    op.add_option("--log-queue", action="store_true", default=False)
+    op.add_option("--log-sample", action="store", type=float, default=1.0)
+    op.add_option("--log-max-payload", action="store", type=int, default=0)
+    op.add_option("--profile-dir", action="store", default=None)
+    op.add_option("--profile-rate", action="store", type=int, default=0)
+    (opts, args) = op.parse_args()
+    REDIS_CUSTOM_CONFIG["batch_window"] = opts.batch_window / 1000
+    REDIS_CUSTOM_CONFIG["local_cache_size"] = opts.local_cache_size
+    REDIS_CUSTOM_CONFIG["write_behind"] = opts.write_behind
+    REDIS_CUSTOM_CONFIG["interests_cache_size"] = opts.interests_cache_size
+    MainHTTPHandler.max_body_size = opts.max_body_size
+    if opts.profile_dir:
+        PROFILER = profiling.Profiler(opts.profile_dir, opts.profile_rate)
+    logs.setup_logging(filename=opts.log,
+                       log_format=opts.log_format,
+                       use_queue=opts.log_queue,
+                       sample_rate=opts.log_sample,
+                       max_payload=opts.log_max_payload)
+    address = ("localhost", opts.port)
+    logging.info("Starting %s server at %s", opts.mode, opts.port)
+
+    if opts.mode == "prefork":
+        run_prefork(address, opts.workers, opts.threads,
+                    opts.pool_stats_interval, opts.store)
+        logs.stop_logging()
+    else:
+        STORE = make_store(opts.store, REDIS_CONFIG, REDIS_CUSTOM_CONFIG)
+        threads = opts.threads if opts.mode == "threaded" else 1
+        serve(make_server(address, threads), opts.pool_stats_interval)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import logging
+import signal
+import time
+import uuid
+from http import HTTPStatus
+from optparse import OptionParser
+
+from scoring_api import api
+from scoring_api import logs
+from scoring_api import metrics
+from scoring_api import scoring
+from scoring_api import timing
+from scoring_api.store import STORES, make_store
+
+MAX_LINE = 65536
+MAX_HEADERS = 100
+NOT_IMPLEMENTED = 501
+
+
+class HTTPError(Exception):
+    def __init__(self, code):
+        super(HTTPError, self).__init__(code)
+        self.code = code
+
+
+class HTTPRequest(object):
+    def __init__(self, method, path, version, headers, body, read_time=0.0):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+        self.read_time = read_time
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+async def read_line(reader):
+    try:
+        line = await reader.readuntil(b"\n")
+    except asyncio.LimitOverrunError:
+        raise HTTPError(api.BAD_REQUEST)
+    if len(line) > MAX_LINE:
+        raise HTTPError(api.BAD_REQUEST)
+    return line.decode("latin-1").rstrip("\r\n")
+
+
+async def read_request(reader, max_body_size=api.MAX_BODY_SIZE):
+    try:
+        request_line = await read_line(reader)
+    except asyncio.IncompleteReadError:
+        return None
+
+    parts = request_line.split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise HTTPError(api.BAD_REQUEST)
+    method, path, version = parts
+
+    headers = {}
+    while True:
+        line = await read_line(reader)
+        if not line:
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(api.BAD_REQUEST)
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HTTPError(api.BAD_REQUEST)
+        headers[name.strip().lower()] = value.strip()
+
+    if "transfer-encoding" in headers:
+        raise HTTPError(NOT_IMPLEMENTED)
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(api.BAD_REQUEST)
+    if length < 0:
+        raise HTTPError(api.BAD_REQUEST)
+    if length > max_body_size:
+        raise HTTPError(api.REQUEST_TOO_LARGE)
+    started = time.perf_counter()
+    body = await reader.readexactly(length) if length else b""
+    return HTTPRequest(method, path, version, headers, body,
+                       time.perf_counter() - started)
+
+
+def write_response(writer, code, body, keep_alive,
+                   content_type="application/json", headers=()):
+    head = [
+        "HTTP/1.1 %d %s" % (code, HTTPStatus(code).phrase),
+        "Content-Type: %s" % content_type,
+        "Content-Length: %d" % len(body),
+        "Connection: %s" % ("keep-alive" if keep_alive else "close"),
+    ]
+    head.extend("%s: %s" % header for header in headers)
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+
+async def online_score_handler(request, ctx, store):
+    req, error = api.prepare_online_score(request, ctx)
+    if error:
+        return error
+
+    if req.is_admin:
+        return {"score": 42}, api.OK
+
+    score = await scoring.get_score_async(store,
+                                          req.phone,
+                                          req.email,
+                                          req.birthday,
+                                          req.gender,
+                                          req.first_name,
+                                          req.last_name)
+    return {"score": score}, api.OK
+
+
+async def clients_interests_handler(request, ctx, store):
+    req, error = api.prepare_clients_interests(request, ctx)
+    if error:
+        return error
+
+    interests = await scoring.get_interests_bulk_async(store, req.client_ids)
+    scores = dict(zip(req.client_ids, interests))
+
+    return scores, api.OK
+
+
+async def online_score_batch_handler(request, ctx, store):
+    req, error = api.prepare_online_score_batch(request, ctx)
+    if error:
+        return error
+
+    profiles = api.validate_profiles(req)
+    columns = api.score_columns(profiles)
+    if req.is_admin:
+        scores = [42] * len(columns[0])
+    else:
+        scores = await scoring.get_scores_async(store, *columns)
+    return api.batch_scores_response(profiles, scores), api.OK
+
+
+async def method_handler(request, ctx, store):
+    body = request["body"]
+    if "method" in body:
+        path = body["method"]
+    else:
+        return ["Unknown method"], api.INVALID_REQUEST
+    router = {
+        "online_score": online_score_handler,
+        "clients_interests": clients_interests_handler,
+        "online_score_batch": online_score_batch_handler,
+    }
+
+    response, code = await router[path]({"body": request["body"]}, ctx,
+                                        store)
+
+    return response, code
+
+
+async def batch_scores(reqs, store):
+    return api.batch_scores_results(
+        await scoring.get_scores_async(store, *api.score_columns(reqs)))
+
+
+async def batch_interests(reqs, store):
+    client_ids = api.batch_client_ids(reqs)
+    interests = await scoring.get_interests_bulk_async(store, client_ids)
+    return api.batch_interests_results(reqs, client_ids, interests)
+
+
+async def batch_handler(request, ctx, store):
+    # the asyncio twin of api.batch_handler: one bulk score read and one
+    # interests fetch for the whole batch
+    body = request["body"]
+    error = api.check_batch(body)
+    if error:
+        return error
+
+    ctx["nrequests"] = len(body)
+    results = [None] * len(body)
+    deferred = {api.OnlineScoreRequest: [], api.ClientsInterestsRequest: []}
+    for i, item in enumerate(body):
+        item_ctx = {"request_id": ctx["request_id"]}
+        try:
+            req, results[i] = api.prepare_batch_item(item, item_ctx)
+            if req is None and results[i] is None:
+                results[i] = await method_handler({"body": item}, item_ctx,
+                                                  store)
+        except Exception as e:
+            logging.exception("Unexpected error: %s", e)
+            req, results[i] = None, (None, api.INTERNAL_ERROR)
+        if req is not None:
+            deferred[type(req)].append((i, req))
+
+    for request_class, answer in (
+            (api.OnlineScoreRequest, batch_scores),
+            (api.ClientsInterestsRequest, batch_interests)):
+        items = deferred[request_class]
+        if not items:
+            continue
+        try:
+            answers = await answer([req for _, req in items], store)
+        except Exception as e:
+            logging.exception("Unexpected error: %s", e)
+            answers = [(None, api.INTERNAL_ERROR)] * len(items)
+        for (i, _), result in zip(items, answers):
+            results[i] = result
+
+    return [api.build_response(response, code)
+            for response, code in results], api.OK
+
+
+class AsyncHTTPServer(object):
+    router = {
+        "method": method_handler,
+        "batch": batch_handler,
+    }
+    keepalive_timeout = api.KEEPALIVE_TIMEOUT
+    max_keepalive_requests = api.MAX_KEEPALIVE_REQUESTS
+    max_body_size = api.MAX_BODY_SIZE
+
+    def __init__(self, store):
+        self.store = store
+
+    def get_request_id(self, headers):
+        return headers.get("x-request-id", uuid.uuid4().hex)
+
+    async def dispatch(self, http_request):
+        if http_request.method == "GET":
+            if http_request.path.strip("/") != "metrics":
+                return api.NOT_FOUND, json.dumps(
+                    api.build_response(None, api.NOT_FOUND)).encode(), None, ()
+            return (api.OK, metrics.REGISTRY.render().encode(),
+                    metrics.CONTENT_TYPE, ())
+        if http_request.method != "POST":
+            return NOT_IMPLEMENTED, json.dumps(
+                {"error": "Unsupported method",
+                 "code": NOT_IMPLEMENTED}).encode(), None, ()
+
+        api.IN_FLIGHT.inc()
+        try:
+            return await self.dispatch_post(http_request)
+        finally:
+            api.IN_FLIGHT.dec()
+
+    async def dispatch_post(self, http_request):
+        started = time.perf_counter()
+        context = {"request_id": self.get_request_id(http_request.headers)}
+        token = timing.start(context)
+        try:
+            return await self.process_post(http_request, started, context)
+        finally:
+            timing.stop(token)
+
+    async def process_post(self, http_request, started, context):
+        response, code = {}, api.OK
+        request = None
+        context["timings"]["read"] = http_request.read_time
+        try:
+            with timing.span("decode"):
+                request = json.loads(http_request.body)
+        except Exception:
+            code = api.BAD_REQUEST
+
+        path = http_request.path.strip("/")
+        # an empty batch is still a batch, and gets 422
+        if request or request == []:
+            if path in self.router:
+                try:
+                    response, code = await self.router[path](
+                        {"body": request}, context, self.store)
+                except Exception as e:
+                    logging.exception("Unexpected error: %s", e)
+                    code = api.INTERNAL_ERROR
+            else:
+                code = api.NOT_FOUND
+
+        r = api.build_response(response, code)
+        with timing.span("serialize"):
+            data = json.dumps(r).encode()
+        duration = time.perf_counter() - started
+        context.update(r)
+        logs.log_request(http_request.path,
+                         http_request.body if request else None, context)
+        api.record_request(path, request, code, duration)
+        headers = []
+        if timing.DEBUG_HEADER.lower() in http_request.headers:
+            context["timings"]["total"] = duration
+            headers.append(("Server-Timing",
+                            timing.server_timing(context["timings"])))
+        return code, data, None, headers
+
+    async def handle_connection(self, reader, writer):
+        requests_served = 0
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        read_request(reader, self.max_body_size),
+                        self.keepalive_timeout)
+                except HTTPError as e:
+                    data = json.dumps(api.build_response(None, e.code))
+                    write_response(writer, e.code, data.encode(), False)
+                    await writer.drain()
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        ConnectionError):
+                    break
+                if request is None:
+                    break
+
+                requests_served += 1
+                keep_alive = (request.keep_alive and requests_served
+                              < self.max_keepalive_requests)
+                code, data, content_type, headers = await self.dispatch(
+                    request)
+                write_response(writer, code, data, keep_alive,
+                               content_type or "application/json", headers)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host, port, store):
+    server = AsyncHTTPServer(store)
+    listener = await asyncio.start_server(server.handle_connection, host, port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    async with listener:
+        await stop.wait()
+    await store.close()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-s", "--store", action="store", type="choice",
+                  choices=sorted(STORES), default="redis")
+    op.add_option("--batch-window", action="store", type=float, default=0)
+    op.add_option("--local-cache-size", action="store", type=int, default=0)
+    op.add_option("--interests-cache-size", action="store", type=int,
+                  default=0)
+    op.add_option("--max-body-size", action="store", type=int,
+                  default=api.MAX_BODY_SIZE)
+    op.add_option("--log-format", action="store", type="choice",
+                  choices=["plain", "json"], default="plain")
+    op.add_option("--log-queue", action="store_true", default=False)
+    op.add_option("--log-sample", action="store", type=float, default=1.0)
+    op.add_option("--log-max-payload", action="store", type=int, default=0)
+    (opts, args) = op.parse_args()
+    api.REDIS_CUSTOM_CONFIG["batch_window"] = opts.batch_window / 1000
+    api.REDIS_CUSTOM_CONFIG["local_cache_size"] = opts.local_cache_size
+    api.REDIS_CUSTOM_CONFIG["interests_cache_size"] = \
+        opts.interests_cache_size
+    AsyncHTTPServer.max_body_size = opts.max_body_size
+    logs.setup_logging(filename=opts.log,
+                       log_format=opts.log_format,
+                       use_queue=opts.log_queue,
+                       sample_rate=opts.log_sample,
+                       max_payload=opts.log_max_payload)
+    logging.info("Starting asyncio server at %s", opts.port)
+    store = make_store(opts.store, api.REDIS_CONFIG, api.REDIS_CUSTOM_CONFIG,
+                       asynchronous=True)
+    asyncio.run(serve("localhost", opts.port, store))
+    logs.stop_logging()
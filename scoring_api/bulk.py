@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+from scoring_api import api
+from scoring_api import logs
+from scoring_api import scoring
+from scoring_api.store import STORES, make_store
+
+CHUNK_SIZE = 1000
+# every record is scored once, so neither the in-process cache nor a
+# background writer that would have to be flushed before a worker exits
+# pays off
+BULK_CUSTOM_CONFIG = dict(api.REDIS_CUSTOM_CONFIG, local_cache_size=0,
+                          write_behind=False)
+
+STORE = None
+
+
+def init_worker(store):
+    global STORE
+    STORE = make_store(store, api.REDIS_CONFIG, BULK_CUSTOM_CONFIG)
+
+
+def score_record(line, store):
+    # the same validation and scoring as online_score, without the envelope
+    # and auth: a line holds the arguments of one request
+    try:
+        arguments = json.loads(line)
+    except ValueError:
+        return None, api.BAD_REQUEST
+    if not isinstance(arguments, dict):
+        return ["Record must be an object"], api.INVALID_REQUEST
+
+    req = api.OnlineScoreRequest({"arguments": arguments})
+    errors_list = req.validate_arguments()
+    if errors_list:
+        return errors_list, api.INVALID_REQUEST
+
+    score = scoring.get_score(store,
+                              req.phone,
+                              req.email,
+                              req.birthday,
+                              req.gender,
+                              req.first_name,
+                              req.last_name)
+    return {"score": score}, api.OK
+
+
+def score_chunk(lines):
+    out, errors = [], 0
+    for line in lines:
+        response, code = score_record(line, STORE)
+        if code != api.OK:
+            errors += 1
+        out.append(json.dumps(api.build_response(response, code)) + "\n")
+    return "".join(out), len(lines), errors
+
+
+def read_chunks(lines, size):
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run(input, output, workers=1, chunk_size=CHUNK_SIZE, store="redis",
+        window=0):
+    # At most `window` chunks are read ahead of the output, so memory stays
+    # flat however long the input is, and chunks are written in input order.
+    stats = {"records": 0, "errors": 0}
+
+    def write(result):
+        text, records, errors = result
+        output.write(text)
+        stats["records"] += records
+        stats["errors"] += errors
+
+    if workers <= 1:
+        init_worker(store)
+        for chunk in read_chunks(input, chunk_size):
+            write(score_chunk(chunk))
+        return stats
+
+    window = window or 2 * workers
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(store,)) as executor:
+        pending = deque()
+        for chunk in read_chunks(input, chunk_size):
+            pending.append(executor.submit(score_chunk, chunk))
+            if len(pending) >= window:
+                write(pending.popleft().result())
+        while pending:
+            write(pending.popleft().result())
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [INPUT [OUTPUT]]")
+    op.add_option("-w", "--workers", action="store", type=int,
+                  default=os.cpu_count() or 1)
+    op.add_option("-c", "--chunk-size", action="store", type=int,
+                  default=CHUNK_SIZE)
+    op.add_option("-s", "--store", action="store", type="choice",
+                  choices=sorted(STORES), default="redis")
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logs.setup_logging(filename=opts.log)
+
+    input = sys.stdin
+    output = sys.stdout
+    if args and args[0] != "-":
+        input = open(args[0])
+    if len(args) > 1 and args[1] != "-":
+        output = open(args[1], "w")
+    try:
+        stats = run(input, output, opts.workers, opts.chunk_size, opts.store)
+    finally:
+        input.close()
+        output.close()
+    logging.info("Scored %(records)d records, %(errors)d errors", stats)
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import threading
+
+from scoring_api.metrics import REGISTRY
+
+BATCH_REQUESTS = REGISTRY.histogram("scoring_store_batch_requests", "Callers served by one batched fetch",
+                                    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class Batch(object):
+    __slots__ = ("keys", "positions", "callers", "full", "done", "results")
+
+    def __init__(self, full, done=None):
+        self.keys = []
+        # key -> index in keys, a key asked for by several callers is
+        # fetched once
+        self.positions = {}
+        self.callers = 0
+        self.full = full
+        self.done = done
+        self.results = None
+
+    def add(self, keys):
+        self.callers += 1
+        indexes = []
+        for key in keys:
+            index = self.positions.get(key)
+            if index is None:
+                index = self.positions[key] = len(self.keys)
+                self.keys.append(key)
+            indexes.append(index)
+        return indexes
+
+    def take(self, indexes):
+        if self.results is None:
+            return None
+        return [self.results[i] for i in indexes]
+
+
+class ListLoader(object):
+    # Collects the keys concurrent callers of load_many ask for during
+    # `window` seconds, or until `max_batch` keys are queued, and gets them
+    # with one fetch(keys) call. The first caller of a batch runs the fetch,
+    # the others wait for it.
+
+    def __init__(self, fetch, window=0.001, max_batch=500):
+        self.fetch = fetch
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.pending = None
+
+    def load_many(self, keys):
+        with self.lock:
+            batch = self.pending
+            leader = batch is None
+            if leader:
+                batch = self.pending = Batch(threading.Event(), threading.Event())
+            indexes = batch.add(keys)
+            if len(batch.keys) >= self.max_batch:
+                self.pending = None
+                batch.full.set()
+
+        if not leader:
+            batch.done.wait()
+            return batch.take(indexes)
+
+        batch.full.wait(self.window)
+        with self.lock:
+            if self.pending is batch:
+                self.pending = None
+        try:
+            batch.results = self.fetch(batch.keys)
+        except Exception:
+            # every caller gets None, like from a store that failed the fetch
+            logging.exception("Cannot fetch a batch of %d lists", len(batch.keys))
+        finally:
+            BATCH_REQUESTS.observe(value=batch.callers)
+            batch.done.set()
+        return batch.take(indexes)
+
+
+class AsyncListLoader(object):
+    # ListLoader for one event loop: the fetch runs in its own task, so a
+    # cancelled caller doesn't cancel it for the others
+
+    def __init__(self, fetch, window=0.001, max_batch=500):
+        self.fetch = fetch
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = None
+
+    async def load_many(self, keys):
+        batch = self.pending
+        if batch is None:
+            loop = asyncio.get_running_loop()
+            batch = self.pending = Batch(asyncio.Event(), loop.create_future())
+            timer = loop.call_later(self.window, batch.full.set)
+            loop.create_task(self.dispatch(batch, timer))
+        indexes = batch.add(keys)
+        if len(batch.keys) >= self.max_batch:
+            self.pending = None
+            batch.full.set()
+        await asyncio.shield(batch.done)
+        return batch.take(indexes)
+
+    async def dispatch(self, batch, timer):
+        await batch.full.wait()
+        timer.cancel()
+        if self.pending is batch:
+            self.pending = None
+        try:
+            batch.results = await self.fetch(batch.keys)
+        except Exception:
+            logging.exception("Cannot fetch a batch of %d lists", len(batch.keys))
+        finally:
+            BATCH_REQUESTS.observe(value=batch.callers)
+            batch.done.set_result(None)
+
+
+class BatchingStore(object):
+    # Wraps a store so that interests lookups of concurrent requests share
+    # pipelined fetches; everything else goes straight to the store.
+
+    def __init__(self, store, window=0.001, max_batch=500):
+        self.store = store
+        self.loader = ListLoader(store.get_lists, window, max_batch)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def get_list(self, key):
+        lists = self.loader.load_many([key])
+        return lists[0] if lists is not None else None
+
+    def get_lists(self, keys):
+        return self.loader.load_many(keys)
+
+
+class AsyncBatchingStore(object):
+
+    def __init__(self, store, window=0.001, max_batch=500):
+        self.store = store
+        self.loader = AsyncListLoader(store.get_lists, window, max_batch)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    async def get_list(self, key):
+        lists = await self.loader.load_many([key])
+        return lists[0] if lists is not None else None
+
+    async def get_lists(self, keys):
+        return await self.loader.load_many(keys)
@@ -0,0 +1,176 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import zlib
+
+LOG_FORMAT = '[%(asctime)s] %(levelname).1s %(message)s'
+DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+QUEUE_SIZE = 10000
+# longest payload (request body, response context) written to the log,
+# 0 keeps payloads whole
+MAX_PAYLOAD = 0
+
+_listener = None
+_queue_handler = None
+
+
+class Payload(object):
+    # Defers str() of a request body or context until a handler formats the
+    # record, and cuts it to MAX_PAYLOAD characters when it does.
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = str(self.value)
+        if MAX_PAYLOAD and len(text) > MAX_PAYLOAD:
+            return "%s...(%d more)" % (text[:MAX_PAYLOAD], len(text) - MAX_PAYLOAD)
+        return text
+
+    def json_value(self):
+        # the payload as a JSON value: a request body is decoded, and a
+        # payload longer than MAX_PAYLOAD once serialized is cut to a string
+        value = self.value
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        text = json.dumps(value, ensure_ascii=False, default=str)
+        if MAX_PAYLOAD and len(text) > MAX_PAYLOAD:
+            return "%s...(%d more)" % (text[:MAX_PAYLOAD], len(text) - MAX_PAYLOAD)
+        return value
+
+    def snapshot(self):
+        # a copy that the caller can keep mutating the original behind,
+        # down to the nested dicts (timings) of a request context
+        if isinstance(self.value, dict):
+            return Payload({key: dict(value) if isinstance(value, dict) else value
+                            for key, value in self.value.items()})
+        return self
+
+
+class JsonFormatter(logging.Formatter):
+    # A record of log_request carries its body or context as a payload field,
+    # written as a JSON value in place of the plain format's message.
+    fields = ("request_id", "path", "code")
+    payloads = (("body", "request"), ("context", "response"))
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+        }
+        for field, msg in self.payloads:
+            payload = getattr(record, field, None)
+            if isinstance(payload, Payload):
+                entry["msg"] = msg
+                entry[field] = payload.json_value()
+                break
+        else:
+            entry["msg"] = record.getMessage()
+        for field in self.fields:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps 1 of every 1/rate successful requests. The decision is a hash of
+    # the request id, so all records of a request are kept or dropped
+    # together; errors and non-request records always pass.
+    def __init__(self, rate=1.0):
+        super(SamplingFilter, self).__init__()
+        self.threshold = int(rate * 2 ** 32)
+
+    def filter(self, record):
+        code = getattr(record, "code", None)
+        if code is None or code >= 400 or record.levelno >= logging.WARNING:
+            return True
+        request_id = getattr(record, "request_id", "")
+        return zlib.crc32(request_id.encode()) < self.threshold
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super(LazyQueueHandler, self).__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # leave formatting to the listener thread, but hand it payloads the
+        # request can no longer change
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg.snapshot() if isinstance(arg, Payload) else arg
+                                for arg in record.args)
+        for field, _ in JsonFormatter.payloads:
+            payload = getattr(record, field, None)
+            if isinstance(payload, Payload):
+                setattr(record, field, payload.snapshot())
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def log_request(path, body, context):
+    extra = {"request_id": context.get("request_id"), "path": path,
+             "code": context.get("code")}
+    if body is not None:
+        body = Payload(body)
+        logging.info("%s: %s %s", path, body, context.get("request_id"), extra=dict(extra, body=body))
+    context = Payload(context)
+    logging.info("%s", context, extra=dict(extra, context=context))
+
+
+def setup_logging(filename=None, log_format="plain", use_queue=False, sample_rate=1.0, max_payload=0):
+    global MAX_PAYLOAD, _listener, _queue_handler
+    MAX_PAYLOAD = max_payload
+
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    if use_queue:
+        _queue_handler = LazyQueueHandler(queue.Queue(QUEUE_SIZE))
+        _queue_handler.addFilter(SamplingFilter(sample_rate))
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, handler, respect_handler_level=True)
+        _listener.start()
+        root.addHandler(_queue_handler)
+    else:
+        handler.addFilter(SamplingFilter(sample_rate))
+        root.addHandler(handler)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _restart_after_fork():
+    # the listener thread doesn't survive fork: give the child its own
+    global _listener
+    if _listener is None:
+        return
+    _queue_handler.queue = queue.Queue(QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, *_listener.handlers,
+                                               respect_handler_level=True)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
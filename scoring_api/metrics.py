@@ -0,0 +1,170 @@
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    # Every thread updates its own shard, so the hot path takes no lock; the
+    # lock is only held to register a new thread's shard and to collect.
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                self.shards.append(values)
+            return values
+
+    def snapshot(self):
+        with self.lock:
+            shards = [shard.copy() for shard in self.shards]
+        return shards
+
+    def render(self, extra=()):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        lines.extend(self.samples(extra))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self.shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self):
+        totals = {}
+        for shard in self.snapshot():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def samples(self, extra=()):
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, labels, extra), format_value(value))
+                for labels, value in sorted(self.values().items())]
+
+
+class Gauge(Counter):
+    # a gauge that goes up and down is the sum of per-thread deltas
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class CallbackGauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames, callback):
+        super(CallbackGauge, self).__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def samples(self, extra=()):
+        values = self.callback() or {}
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, labels, extra), format_value(value))
+                for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value):
+        shard = self.shard()
+        # [count per bucket..., count above the last bucket, sum]
+        state = shard.get(labels)
+        if state is None:
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def values(self):
+        totals = {}
+        for shard in self.snapshot():
+            for labels, state in shard.items():
+                total = totals.setdefault(labels, [0] * (len(self.buckets) + 1) + [0.0])
+                for i, value in enumerate(list(state)):
+                    total[i] += value
+        return totals
+
+    def samples(self, extra=()):
+        lines = []
+        for labels, state in sorted(self.values().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name,
+                                                 format_labels(self.labelnames, labels,
+                                                               list(extra) + [("le", format_value(float(bound)))]),
+                                                 cumulative))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(self.labelnames, labels, extra), repr(state[-1])))
+            lines.append("%s_count%s %d" % (self.name, format_labels(self.labelnames, labels, extra), cumulative))
+        return lines
+
+
+class Registry(object):
+    # const_labels, (name, value) pairs, are added to every sample, e.g. the
+    # pid of a prefork worker whose registry is one of many behind a port
+
+    def __init__(self, const_labels=()):
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.const_labels = tuple(const_labels)
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def callback_gauge(self, name, documentation, labelnames, callback):
+        return self.register(CallbackGauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(self.const_labels))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
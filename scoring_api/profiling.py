@@ -0,0 +1,70 @@
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+TRIGGER_HEADER = "X-Profile"
+
+
+class Profiler(object):
+    # Runs cProfile on every `rate`-th request (0 turns sampling off) and on
+    # requests with TRIGGER_HEADER, and keeps one aggregated pstats.Stats per
+    # method until dump() writes them to `directory`.
+    def __init__(self, directory, rate=0):
+        self.directory = directory
+        self.rate = rate
+        self.requests = 0
+        self.profiled = 0
+        self.skipped = 0
+        self.stats = {}
+        # only one request is profiled at a time: cProfile adds a lot of
+        # overhead, and a busy profiler never makes a request wait for it
+        self.active = threading.Lock()
+        self.lock = threading.Lock()
+
+    def wanted(self, headers):
+        if TRIGGER_HEADER in headers:
+            return True
+        if not self.rate:
+            return False
+        # a racy counter is fine, sampling doesn't need to be exact
+        self.requests += 1
+        return self.requests % self.rate == 0
+
+    def run(self, method, headers, func, *args):
+        if not self.wanted(headers):
+            return func(*args)
+        if not self.active.acquire(blocking=False):
+            self.skipped += 1
+            return func(*args)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            self.active.release()
+            self.add(method, profile)
+
+    def add(self, method, profile):
+        with self.lock:
+            self.profiled += 1
+            if method in self.stats:
+                self.stats[method].add(profile)
+            else:
+                self.stats[method] = pstats.Stats(profile)
+
+    def dump(self):
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        os.makedirs(self.directory, exist_ok=True)
+        suffix = "%d-%s" % (os.getpid(), time.strftime("%Y%m%d%H%M%S"))
+        paths = []
+        for method, method_stats in sorted(stats.items()):
+            path = os.path.join(self.directory, "%s-%s.prof" % (method, suffix))
+            method_stats.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def summary(self):
+        with self.lock:
+            return {"profiled": self.profiled, "skipped": self.skipped, "methods": sorted(self.stats)}
@@ -1,20 +1,27 @@
 import hashlib
 import json
 
+from scoring_api.metrics import REGISTRY
+from scoring_api.singleflight import AsyncSingleFlight, SingleFlight
+from scoring_api.timing import span
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+SCORE_CACHE = REGISTRY.counter("scoring_score_cache_total", "Score cache lookups by result", ("result",))
+SCORE_FLIGHTS = SingleFlight()
+ASYNC_SCORE_FLIGHTS = AsyncSingleFlight()
+
+
+def get_score_key(phone, birthday=None, first_name=None, last_name=None):
     key_parts = [
         first_name or "",
         last_name or "",
         str(phone) or "",
         str(birthday) if birthday is not None else "",
     ]
-    key = "uid:" + hashlib.md5(("".join(key_parts)).encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)
+    return "uid:" + hashlib.md5(("".join(key_parts)).encode('utf-8')).hexdigest()
+
+
+def calculate_score(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -23,12 +30,148 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def calculate_scores(phones, emails, birthdays, genders, first_names, last_names):
+    # calculate_score over columns of profiles
+    return [(1.5 if phone else 0) + (1.5 if email else 0) + (1.5 if birthday and gender else 0) +
+            (0.5 if first_name and last_name else 0)
+            for phone, email, birthday, gender, first_name, last_name
+            in zip(phones, emails, birthdays, genders, first_names, last_names)]
+
+
+def plan_scores(cached, keys, columns):
+    # scores of the cache hits, and the (key, score) pairs to cache for the
+    # misses; a key missed twice in one batch is calculated once
+    cached = cached or [None] * len(keys)
+    scores = [float(value) if value is not None else None for value in cached]
+    misses = {}
+    for i, value in enumerate(cached):
+        if value is None:
+            misses.setdefault(keys[i], i)
+    rows = list(misses.values())
+    calculated = calculate_scores(*[[column[i] for i in rows] for column in columns])
+    computed = dict(zip(misses, calculated))
+    for i, key in enumerate(keys):
+        if scores[i] is None:
+            scores[i] = computed[key]
+    SCORE_CACHE.inc("hit", amount=len(keys) - sum(1 for value in cached if value is None))
+    SCORE_CACHE.inc("miss", amount=len(computed))
+    return scores, list(computed.items())
+
+
+def get_scores(store, phones, emails, birthdays, genders, first_names, last_names):
+    # get_score for many profiles: one bulk read of the cache, one bulk write
+    # of the scores calculated for the misses
+    columns = (phones, emails, birthdays, genders, first_names, last_names)
+    keys = [get_score_key(phone, birthday, first_name, last_name)
+            for phone, birthday, first_name, last_name in zip(phones, birthdays, first_names, last_names)]
+    if not keys:
+        return []
+    with span("store"):
+        cached = store.cache_get_many(keys)
+    with span("scoring"):
+        scores, computed = plan_scores(cached, keys, columns)
+    if computed:
+        with span("store"):
+            store.cache_set_many(computed, 60 * 60)
+    return scores
+
+
+async def get_scores_async(store, phones, emails, birthdays, genders, first_names, last_names):
+    columns = (phones, emails, birthdays, genders, first_names, last_names)
+    keys = [get_score_key(phone, birthday, first_name, last_name)
+            for phone, birthday, first_name, last_name in zip(phones, birthdays, first_names, last_names)]
+    if not keys:
+        return []
+    with span("store"):
+        cached = await store.cache_get_many(keys)
+    with span("scoring"):
+        scores, computed = plan_scores(cached, keys, columns)
+    if computed:
+        with span("store"):
+            await store.cache_set_many(computed, 60 * 60)
+    return scores
+
+
+def compute_score(store, key, phone, email, birthday, gender, first_name, last_name):
+    with span("scoring"):
+        score = calculate_score(phone, email, birthday, gender, first_name, last_name)
     # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
+    with span("store"):
+        store.cache_set(key, score, 60 * 60)
+    return score
+
+
+async def compute_score_async(store, key, phone, email, birthday, gender, first_name, last_name):
+    with span("scoring"):
+        score = calculate_score(phone, email, birthday, gender, first_name, last_name)
+    with span("store"):
+        await store.cache_set(key, score, 60 * 60)
     return score
 
 
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    with span("store"):
+        score = store.cache_get(key)
+    if score is not None:
+        SCORE_CACHE.inc("hit")
+        return float(score)
+    # concurrent misses of the same key wait for one calculation and write
+    score, shared = SCORE_FLIGHTS.do(key, compute_score, store, key, phone, email, birthday, gender,
+                                     first_name, last_name)
+    SCORE_CACHE.inc("coalesced" if shared else "miss")
+    return score
+
+
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, birthday, first_name, last_name)
+    with span("store"):
+        score = await store.cache_get(key)
+    if score is not None:
+        SCORE_CACHE.inc("hit")
+        return float(score)
+    score, shared = await ASYNC_SCORE_FLIGHTS.do(key, compute_score_async, store, key, phone, email, birthday,
+                                                 gender, first_name, last_name)
+    SCORE_CACHE.inc("coalesced" if shared else "miss")
+    return score
+
+
+def decode_interests(r):
+    # stores return LRANGE replies as bytes, responses are JSON
+    return [i.decode("utf-8") if isinstance(i, bytes) else i for i in r] if r else []
+
+
 def get_interests(store, cid):
-    r = store.get_list(cid)
-    return r if r else []
+    with span("store"):
+        r = store.get_list(cid)
+    return decode_interests(r)
+
+
+async def get_interests_async(store, cid):
+    with span("store"):
+        r = await store.get_list(cid)
+    return decode_interests(r)
+
+
+def iter_interests(store, cids, chunk_size):
+    # (cid, interests) pairs, one pipelined fetch per chunk of cids
+    for start in range(0, len(cids), chunk_size):
+        chunk = cids[start:start + chunk_size]
+        yield list(zip(chunk, get_interests_bulk(store, chunk)))
+
+
+def get_interests_bulk(store, cids):
+    with span("store"):
+        lists = store.get_lists(cids) or [None] * len(cids)
+    return [decode_interests(r) for r in lists]
+
 
+async def get_interests_bulk_async(store, cids):
+    with span("store"):
+        lists = await store.get_lists(cids) or [None] * len(cids)
+    return [decode_interests(r) for r in lists]
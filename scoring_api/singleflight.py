@@ -0,0 +1,75 @@
+import asyncio
+import threading
+
+
+class Call(object):
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    # do(key, fn, *args) runs fn once per key at a time: callers that come
+    # while it runs wait for it and share its result (or its exception).
+    # Returns (result, shared).
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result, False
+
+
+class AsyncSingleFlight(object):
+    # SingleFlight for coroutines of one event loop; no lock is needed as
+    # the check and the insert happen without an await in between
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn, *args):
+        future = self.calls.get(key)
+        if future is not None:
+            # a cancelled follower must not cancel the shared call
+            return await asyncio.shield(future), True
+
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # the leader re-raises it, followers are optional
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.calls[key]
+        return result, False
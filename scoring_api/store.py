@@ -1,61 +1,1092 @@
+import abc
+import asyncio
 import logging
+import random
+import threading
 import time
+from collections import OrderedDict
 
 import redis
+import redis.asyncio
 
+from scoring_api.dataloader import AsyncBatchingStore, BatchingStore
+from scoring_api.metrics import REGISTRY
 
-class Store(object):
+STORE_LATENCY = REGISTRY.histogram("scoring_store_duration_seconds", "Store command latency",
+                                   ("operation",))
+STORE_RETRIES = REGISTRY.counter("scoring_store_retries_total", "Store command retries", ("operation",))
+STORE_ERRORS = REGISTRY.counter("scoring_store_errors_total", "Failed or short-circuited store commands",
+                                ("operation", "reason"))
+
+
+class PoolStatsMixin:
+    def reset(self):
+        super(PoolStatsMixin, self).reset()
+        self.stats_lock = threading.Lock()
+        self.acquired = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.monotonic()
+        connection = super(PoolStatsMixin, self).get_connection(command_name, *keys, **options)
+        waited = time.monotonic() - started
+        with self.stats_lock:
+            self.acquired += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return connection
+
+    def stats(self):
+        in_use, idle = self.connection_counts()
+        with self.stats_lock:
+            acquired, wait_time, max_wait_time = self.acquired, self.wait_time, self.max_wait_time
+        return {
+            "max_connections": self.max_connections,
+            "in_use": in_use,
+            "idle": idle,
+            "acquired": acquired,
+            "avg_wait_ms": wait_time / acquired * 1000 if acquired else 0.0,
+            "max_wait_ms": max_wait_time * 1000,
+        }
+
+
+class StatsConnectionPool(PoolStatsMixin, redis.ConnectionPool):
+    def connection_counts(self):
+        with self._lock:
+            return len(self._in_use_connections), len(self._available_connections)
+
+
+class StatsBlockingConnectionPool(PoolStatsMixin, redis.BlockingConnectionPool):
+    def connection_counts(self):
+        idle = sum(1 for connection in list(self.pool.queue) if connection is not None)
+        return len(self._connections) - idle, idle
+
+
+def make_connection_pool(connect_params, custom_config):
+    if custom_config.get("blocking_pool"):
+        return StatsBlockingConnectionPool(timeout=custom_config.get("pool_timeout", 20), **connect_params)
+    return StatsConnectionPool(**connect_params)
+
+
+class LocalCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[1] > now:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, expire_timeout):
+        expires_at = time.monotonic() + expire_timeout
+        with self.lock:
+            self.items[key] = (value, expires_at)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class RetryPolicy(object):
+
+    def __init__(self, attempts=3, base_delay=0.05, max_delay=1.0, deadline=2.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delays(self):
+        # "full jitter" exponential backoff; None marks the last attempt
+        for attempt in range(self.attempts - 1):
+            yield random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        yield None
+
+
+class CircuitBreaker(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let a single probe through, everyone else keeps failing fast
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self.lock:
+            if self.state != self.CLOSED:
+                logging.info("Redis circuit breaker closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED
+                                                and self.failures >= self.failure_threshold):
+                logging.warning("Redis circuit breaker opened")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def abandon(self):
+        # the call settled nothing about Redis (cancelled, or a bug of ours):
+        # a half-open probe is reopened so that a later one can run, and a
+        # closed breaker counts nothing
+        if self.state != self.HALF_OPEN:
+            return
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+def make_retry_policy(custom_config):
+    return RetryPolicy(attempts=custom_config.get("reconnect_attempts", 3),
+                       base_delay=custom_config.get("retry_base_delay", 0.05),
+                       max_delay=custom_config.get("retry_max_delay", 1.0),
+                       deadline=custom_config.get("retry_deadline", 2.0))
+
+
+def make_circuit_breaker(custom_config):
+    return CircuitBreaker(failure_threshold=custom_config.get("breaker_failure_threshold", 5),
+                          reset_timeout=custom_config.get("breaker_reset_timeout", 5.0))
+
+
+# the score cache is an optimization: one attempt, then fall back to computing
+CACHE_RETRY_POLICY = RetryPolicy(attempts=1)
+
+
+def make_local_cache(custom_config):
+    max_size = custom_config.get("local_cache_size", 0)
+    return LocalCache(max_size) if max_size > 0 else None
+
+
+class WriteBehindQueue(object):
+
+    def __init__(self, write, max_size=10000, batch_size=500, interval=0.05):
+        self.write = write
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        # key -> (value, expire_timeout); a newer write to a queued key
+        # replaces the older one instead of taking another slot
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.coalesced = 0
+        self.dropped = 0
+
+    def put(self, key, value, expire_timeout):
+        with self.condition:
+            if self.closed:
+                return False
+            if key in self.pending:
+                self.coalesced += 1
+            elif len(self.pending) >= self.max_size:
+                self.dropped += 1
+                return False
+            self.pending[key] = (value, expire_timeout)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="write-behind", daemon=True)
+                self.thread.start()
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.condition.notify()
+            return True
+
+    def take_batch(self):
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            key, (value, expire_timeout) = self.pending.popitem(last=False)
+            batch.append((key, value, expire_timeout))
+        return batch
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.pending and not self.closed:
+                    self.condition.wait()
+                if len(self.pending) < self.batch_size and not self.closed:
+                    # give concurrent writers a moment to fill the batch
+                    self.condition.wait(self.interval)
+                batch = self.take_batch()
+                if not batch and self.closed:
+                    return
+            if batch:
+                try:
+                    self.write(batch)
+                except Exception:
+                    logging.exception("Cannot flush write-behind batch")
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+            }
+
+
+class InterestsCache(object):
+    # Lists read by get_list/get_lists, kept until Redis publishes a keyspace
+    # notification for the key, whoever wrote it. Entries are served only
+    # while the subscription is up: it is cleared when the subscription drops
+    # or is (re)established, and `ttl` bounds how long an entry can outlive a
+    # notification that got lost anyway.
+
+    # interests are stored under bare client ids; only keys that look like
+    # one are subscribed to and cached, so score cache writes (uid:<md5>)
+    # never reach the listener
+    PATTERNS = (b"[0-9]*", b"-[0-9]*")
+
+    def __init__(self, connect_params, max_size=10000, ttl=300.0, configure=False, configured=False):
+        self.connect_params = connect_params
+        self.cache = LocalCache(max_size)
+        self.ttl = ttl
+        # turn notifications on with CONFIG SET if the server has them off
+        self.configure = configure
+        # trust that they are on without asking (CONFIG disabled)
+        self.configured = configured
+        self.prefix = b"__keyspace@%d__:" % connect_params.get("db", 0)
+        self.lock = threading.Lock()
+        # bumped when the subscription (re)starts: no fetch started before
+        # is cached
+        self.epoch = 0
+        # key -> sequence of its last invalidation, kept while fetches are
+        # in flight, so a fetch that may have read the old list of a key
+        # doesn't cache it
+        self.sequence = 0
+        self.fetches = 0
+        self.written = {}
+        self.listening = False
+        self.closing = threading.Event()
+        self.thread = None
+        self.invalidations = 0
+        self.resets = 0
+
+    @staticmethod
+    def watched(key):
+        return key[:1].isdigit() or (key[:1] == b"-" and key[1:2].isdigit())
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None and not self.closing.is_set():
+                self.thread = threading.Thread(target=self.run, name="interests-invalidation", daemon=True)
+                self.thread.start()
+
+    def lookup(self, keys):
+        # cached lists, None for misses
+        self.start()
+        if not self.listening:
+            return [None] * len(keys)
+        values = [self.cache.get(key) if self.watched(key) else None for key in keys]
+        return [list(value) if value is not None else None for value in values]
+
+    def begin(self):
+        # a token for finish, taken before the lists are fetched
+        with self.lock:
+            self.fetches += 1
+            return self.epoch, self.sequence
+
+    def finish(self, token, keys, values):
+        # values is None when the fetch failed
+        epoch, sequence = token
+        with self.lock:
+            self.fetches -= 1
+            if values is not None and self.listening and epoch == self.epoch:
+                for key, value in zip(keys, values):
+                    if self.watched(key) and self.written.get(key, -1) <= sequence:
+                        self.cache.set(key, list(value), self.ttl)
+            if not self.fetches:
+                self.written.clear()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.sequence += 1
+            if self.fetches:
+                self.written[key] = self.sequence
+            self.invalidations += 1
+            self.cache.delete(key)
+
+    def reset(self, listening):
+        with self.lock:
+            self.epoch += 1
+            self.resets += 1
+            self.listening = listening
+            self.cache.clear()
+
+    def handle(self, message):
+        if message["type"] == "psubscribe":
+            # writes made before the subscription went through were missed
+            self.reset(True)
+        elif message["type"] == "pmessage":
+            self.invalidate(message["channel"][len(self.prefix):])
+
+    def enable_notifications(self, client):
+        # "K" publishes events on __keyspace@<db>__:<key>; "g$lxe" (all part
+        # of "A") cover deletes, overwrites, list commands, expiry and eviction
+        if self.configured:
+            return True
+        try:
+            flags = list(client.config_get("notify-keyspace-events").values())
+        except redis.ResponseError:
+            return False
+        flags = flags[0] if flags else b""
+        flags = flags.decode() if isinstance(flags, bytes) else flags
+        if "K" in flags and ("A" in flags or all(flag in flags for flag in "g$lxe")):
+            return True
+        if not self.configure:
+            return False
+        try:
+            client.config_set("notify-keyspace-events", "".join(sorted(set(flags + "KA"))))
+        except redis.ResponseError:
+            return False
+        logging.info("Enabled Redis keyspace notifications for the interests cache")
+        return True
+
+    def run(self):
+        client = redis.Redis(**self.connect_params)
+        delay = 0.1
+        while not self.closing.is_set():
+            pubsub = client.pubsub()
+            try:
+                if not self.enable_notifications(client):
+                    logging.error("Redis keyspace notifications are off (notify-keyspace-events needs K and A), "
+                                  "interests are not cached")
+                    break
+                pubsub.psubscribe(*[self.prefix + pattern for pattern in self.PATTERNS])
+                while not self.closing.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self.handle(message)
+                        delay = 0.1
+            except redis.RedisError:
+                if self.listening:
+                    logging.warning("Lost Redis keyspace notifications, interests cache is off until resubscribed")
+            finally:
+                self.reset(False)
+                pubsub.close()
+            self.closing.wait(delay)
+            delay = min(delay * 2, 5.0)
+        client.close()
+
+    def close(self):
+        self.closing.set()
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self.lock:
+            stats.update(listening=self.listening, invalidations=self.invalidations, resets=self.resets)
+        return stats
+
+
+def make_interests_cache(connect_params, custom_config):
+    max_size = custom_config.get("interests_cache_size", 0)
+    if max_size <= 0:
+        return None
+    return InterestsCache(connect_params, max_size, custom_config.get("interests_cache_ttl", 300.0),
+                          configure=custom_config.get("interests_cache_configure", False),
+                          configured=custom_config.get("interests_cache_notifications", False))
+
+
+class BaseStore(abc.ABC):
+    # The interface handlers and scoring rely on. Values come back the way a
+    # Redis GET/LRANGE returns them (bytes); reads return None, and bulk reads
+    # None for the whole batch, when the backend is unavailable.
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def get_list(self, key):
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    def set_list(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    def cache_get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def cache_set(self, key, value, expire_timeout):
+        pass
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def get_lists(self, keys):
+        return [self.get_list(key) for key in keys]
+
+    def cache_get_many(self, keys):
+        return [self.cache_get(key) for key in keys]
+
+    def cache_set_many(self, items, expire_timeout):
+        for key, value in items:
+            self.cache_set(key, value, expire_timeout)
+
+    def pool_stats(self):
+        return None
+
+    def local_cache_stats(self):
+        return None
+
+    def write_behind_stats(self):
+        return None
+
+    def interests_cache_stats(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class AsyncBaseStore(abc.ABC):
+    # BaseStore for the asyncio server: the same calls, awaited
+
+    @abc.abstractmethod
+    async def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    async def get_list(self, key):
+        pass
+
+    @abc.abstractmethod
+    async def set(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    async def set_list(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    async def cache_get(self, key):
+        pass
+
+    @abc.abstractmethod
+    async def cache_set(self, key, value, expire_timeout):
+        pass
+
+    async def get_many(self, keys):
+        return [await self.get(key) for key in keys]
+
+    async def get_lists(self, keys):
+        return [await self.get_list(key) for key in keys]
+
+    async def cache_get_many(self, keys):
+        return [await self.cache_get(key) for key in keys]
+
+    async def cache_set_many(self, items, expire_timeout):
+        for key, value in items:
+            await self.cache_set(key, value, expire_timeout)
+
+    def pool_stats(self):
+        return None
+
+    def local_cache_stats(self):
+        return None
+
+    def interests_cache_stats(self):
+        return None
+
+    async def close(self):
+        pass
+
+
+class MemoryStore(BaseStore):
+    # In-process backend with Redis semantics (values are encoded to bytes,
+    # cache entries expire) for local runs and benchmarks without a server.
+
+    def __init__(self, connect_params=None, custom_config=None):
+        self.encoder = redis.connection.Encoder("utf-8", "strict", False)
+        # key -> (value, expires_at or None)
+        self.items = {}
+        self.lock = threading.Lock()
+        self.next_sweep = 1024
+
+    def _get(self, key, now):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            del self.items[key]
+            return None
+        return item[0]
+
+    def _set(self, key, value, expires_at=None):
+        self.items[key] = (value, expires_at)
+        if len(self.items) >= self.next_sweep:
+            # drop expired entries nobody asked for again, amortized over
+            # the writes that grew the dict
+            now = time.monotonic()
+            for expired in [k for k, (_, at) in self.items.items() if at is not None and at <= now]:
+                del self.items[expired]
+            self.next_sweep = max(1024, 2 * len(self.items))
+
+    def key(self, key):
+        return self.encoder.encode(key)
+
+    def get(self, key):
+        with self.lock:
+            value = self._get(self.key(key), time.monotonic())
+        return value if not isinstance(value, list) else None
+
+    def get_list(self, key):
+        with self.lock:
+            value = self._get(self.key(key), time.monotonic())
+        return list(value) if isinstance(value, list) else []
+
+    def get_many(self, keys):
+        keys = [self.key(key) for key in keys]
+        now = time.monotonic()
+        with self.lock:
+            values = [self._get(key, now) for key in keys]
+        return [value if not isinstance(value, list) else None for value in values]
+
+    def get_lists(self, keys):
+        keys = [self.key(key) for key in keys]
+        now = time.monotonic()
+        with self.lock:
+            values = [self._get(key, now) for key in keys]
+        return [list(value) if isinstance(value, list) else [] for value in values]
+
+    def set(self, key, value):
+        key, value = self.key(key), self.encoder.encode(value)
+        with self.lock:
+            self._set(key, value)
+        return True
+
+    def set_list(self, key, value):
+        key, value = self.key(key), [self.encoder.encode(item) for item in value]
+        with self.lock:
+            self._set(key, value)
+        return len(value)
+
+    def cache_get(self, key):
+        return self.get(key)
+
+    def cache_get_many(self, keys):
+        return self.get_many(keys)
+
+    def cache_set(self, key, value, expire_timeout):
+        self.cache_set_many([(key, value)], expire_timeout)
+
+    def cache_set_many(self, items, expire_timeout):
+        items = [(self.key(key), self.encoder.encode(value)) for key, value in items]
+        expires_at = time.monotonic() + expire_timeout
+        with self.lock:
+            for key, value in items:
+                self._set(key, value, expires_at)
+
+
+class Store(BaseStore):
+    # redis.Redis checks a connection out of the pool for every command (and
+    # a pipeline for the duration of execute), so a single Store can be shared
+    # by all handler threads of a process.
 
     def __init__(self, connect_params, custom_config):
         self.connect_params = connect_params
         self.redis_client = None
-        self.redis_client = redis.Redis(**self.connect_params)
-        self.reconnect_attempts = custom_config["reconnect_attempts"] if "reconnect_attempts" in custom_config else 3
+        self.connection_pool = make_connection_pool(self.connect_params, custom_config)
+        self.redis_client = redis.Redis(connection_pool=self.connection_pool)
+        self.retry_policy = make_retry_policy(custom_config)
+        self.breaker = make_circuit_breaker(custom_config)
+        # optional in-process L1 in front of cache_get/cache_set
+        self.local_cache = make_local_cache(custom_config)
+        self.encoder = self.connection_pool.get_encoder()
+        self.write_behind = None
+        if custom_config.get("write_behind"):
+            self.write_behind = WriteBehindQueue(self.write_cache_batch,
+                                                 max_size=custom_config.get("write_behind_size", 10000),
+                                                 batch_size=custom_config.get("write_behind_batch", 500),
+                                                 interval=custom_config.get("write_behind_interval", 0.05))
+        self.interests_cache = make_interests_cache(connect_params, custom_config)
 
-    def get(self, key):
-        attempts = self.reconnect_attempts
-        while attempts:
+    @property
+    def reconnect_attempts(self):
+        return self.retry_policy.attempts
+
+    def pool_stats(self):
+        return self.connection_pool.stats()
+
+    def local_cache_stats(self):
+        return self.local_cache.stats() if self.local_cache else None
+
+    def write_behind_stats(self):
+        return self.write_behind.stats() if self.write_behind else None
+
+    def interests_cache_stats(self):
+        return self.interests_cache.stats() if self.interests_cache else None
+
+    def close(self):
+        if self.write_behind is not None:
+            self.write_behind.close()
+        if self.interests_cache is not None:
+            self.interests_cache.close()
+        self.connection_pool.disconnect()
+
+    def _call(self, operation, message, command, *args, policy=None):
+        policy = policy or self.retry_policy
+        deadline = time.monotonic() + policy.deadline
+        for attempt, delay in enumerate(policy.delays()):
+            if not self.breaker.allow():
+                STORE_ERRORS.inc(operation, "circuit_open")
+                return None
+            if attempt:
+                STORE_RETRIES.inc(operation)
+            started = time.perf_counter()
             try:
-                return self.redis_client.get(key)
-            except Exception as e:
-                attempts -= 1
-                logging.error("Cannot get value from Redis")
-                time.sleep(2)
+                result = command(*args)
+            except redis.RedisError:
+                STORE_LATENCY.observe(operation, value=time.perf_counter() - started)
+                STORE_ERRORS.inc(operation, "redis")
+                self.breaker.record_failure()
+                logging.error(message)
+            except BaseException:
+                # a half-open probe must not be left unsettled, or every
+                # later call fails fast for good
+                STORE_ERRORS.inc(operation, "unexpected")
+                self.breaker.abandon()
+                raise
+            else:
+                STORE_LATENCY.observe(operation, value=time.perf_counter() - started)
+                self.breaker.record_success()
+                return result
+            if delay is None or time.monotonic() + delay > deadline:
+                return None
+            time.sleep(delay)
+
+    def get(self, key):
+        return self._call("get", "Cannot get value from Redis", self.redis_client.get, key)
 
     def get_list(self, key):
-        attempts = self.reconnect_attempts
-        while attempts:
-            try:
-                return self.redis_client.lrange(key, 0, -1)
-            except Exception as e:
-                attempts -= 1
-                logging.error("Cannot get list of values from Redis")
-                time.sleep(2)
+        if self.interests_cache is not None:
+            lists = self.get_lists([key])
+            return lists[0] if lists is not None else None
+        return self._call("get_list", "Cannot get list of values from Redis", self.redis_client.lrange, key, 0, -1)
+
+    def get_lists(self, keys):
+        if self.interests_cache is None:
+            return self.fetch_lists(keys)
+        names = [self.encoder.encode(key) for key in keys]
+        values = self.interests_cache.lookup(names)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+        token = self.interests_cache.begin()
+        fetched = None
+        try:
+            fetched = self.fetch_lists([keys[i] for i in missing])
+        finally:
+            self.interests_cache.finish(token, [names[i] for i in missing], fetched)
+        if fetched is None:
+            return None
+        for i, value in zip(missing, fetched):
+            values[i] = value
+        return values
+
+    def fetch_lists(self, keys):
+        def fetch_lists():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.lrange(key, 0, -1)
+            return pipeline.execute()
+        return self._call("get_lists", "Cannot get lists of values from Redis", fetch_lists)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self._call("get_many", "Cannot get values from Redis", self.redis_client.mget, keys)
 
     def set(self, key, value):
-        attempts = self.reconnect_attempts
-        while attempts:
-            try:
-                return self.redis_client.set(key, value)
-            except Exception as e:
-                attempts -= 1
-                logging.error("Cannot set value to Redis")
-                time.sleep(2)
+        return self._call("set", "Cannot set value to Redis", self.redis_client.set, key, value)
 
     def set_list(self, key, value):
-        attempts = self.reconnect_attempts
-        while attempts:
-            try:
-                self.redis_client.delete(key)
-                return self.redis_client.rpush(key, *value)
-            except Exception as e:
-                attempts -= 1
-                logging.error("Cannot set value to Redis")
-                time.sleep(2)
+        def replace_list():
+            self.redis_client.delete(key)
+            return self.redis_client.rpush(key, *value)
+        result = self._call("set_list", "Cannot set value to Redis", replace_list)
+        if self.interests_cache is not None:
+            # don't wait for the notification to read our own write
+            self.interests_cache.invalidate(self.encoder.encode(key))
+        return result
 
     def cache_get(self, key):
-        return self.redis_client.get(key)
+        if self.local_cache is None:
+            return self._call("cache_get", "Cannot get cached value from Redis", self.redis_client.get, key,
+                              policy=CACHE_RETRY_POLICY)
+        value = self.local_cache.get(key)
+        if value is not None:
+            return value
+
+        def fetch_with_ttl():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.get(key)
+            pipeline.ttl(key)
+            return pipeline.execute()
+        value, ttl = self._call("cache_get", "Cannot get cached value from Redis", fetch_with_ttl,
+                                policy=CACHE_RETRY_POLICY) or (None, None)
+        if value is not None and ttl > 0:
+            self.local_cache.set(key, value, ttl)
+        return value
 
     def cache_set(self, key, value, expire_timeout):
-        self.redis_client.set(key, value)
-        self.redis_client.expire(key, expire_timeout)
+        if self.local_cache is not None:
+            # keep the value exactly as a Redis GET would return it
+            self.local_cache.set(key, self.encoder.encode(value), expire_timeout)
+        if self.write_behind is not None:
+            self.write_behind.put(key, value, expire_timeout)
+            return
+        self._call("cache_set", "Cannot set cached value to Redis", self.redis_client.set, key, value, expire_timeout,
+                   policy=CACHE_RETRY_POLICY)
+
+    def cache_get_many(self, keys):
+        if self.local_cache is None:
+            if not keys:
+                return []
+            return self._call("cache_get_many", "Cannot get cached values from Redis", self.redis_client.mget, keys,
+                              policy=CACHE_RETRY_POLICY)
+        values = [self.local_cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+
+        def fetch_with_ttl():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for i in missing:
+                pipeline.get(keys[i])
+                pipeline.ttl(keys[i])
+            return pipeline.execute()
+        result = self._call("cache_get_many", "Cannot get cached values from Redis", fetch_with_ttl,
+                            policy=CACHE_RETRY_POLICY)
+        if result is None:
+            return values
+        for i, value, ttl in zip(missing, result[::2], result[1::2]):
+            values[i] = value
+            if value is not None and ttl > 0:
+                self.local_cache.set(keys[i], value, ttl)
+        return values
+
+    def cache_set_many(self, items, expire_timeout):
+        if self.local_cache is not None:
+            for key, value in items:
+                self.local_cache.set(key, self.encoder.encode(value), expire_timeout)
+        if self.write_behind is not None:
+            for key, value in items:
+                self.write_behind.put(key, value, expire_timeout)
+            return
+        if items:
+            self.write_cache_batch([(key, value, expire_timeout) for key, value in items])
+
+    def write_cache_batch(self, batch):
+        def store_values():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key, value, expire_timeout in batch:
+                pipeline.set(key, value, ex=expire_timeout)
+            return pipeline.execute()
+        self._call("cache_set_batch", "Cannot set cached values to Redis", store_values, policy=CACHE_RETRY_POLICY)
+
+
+class AsyncStore(AsyncBaseStore):
+
+    def __init__(self, connect_params, custom_config):
+        self.connect_params = connect_params
+        if custom_config.get("blocking_pool"):
+            pool = redis.asyncio.BlockingConnectionPool(timeout=custom_config.get("pool_timeout", 20),
+                                                        **self.connect_params)
+        else:
+            pool = redis.asyncio.ConnectionPool(**self.connect_params)
+        self.redis_client = redis.asyncio.Redis(connection_pool=pool)
+        self.retry_policy = make_retry_policy(custom_config)
+        self.breaker = make_circuit_breaker(custom_config)
+        self.local_cache = make_local_cache(custom_config)
+        self.encoder = pool.get_encoder()
+        # invalidated from a listener thread, lookups never block the loop
+        self.interests_cache = make_interests_cache(connect_params, custom_config)
+
+    def local_cache_stats(self):
+        return self.local_cache.stats() if self.local_cache else None
+
+    def interests_cache_stats(self):
+        return self.interests_cache.stats() if self.interests_cache else None
+
+    async def _call(self, operation, message, command, *args, policy=None):
+        policy = policy or self.retry_policy
+        deadline = time.monotonic() + policy.deadline
+        for attempt, delay in enumerate(policy.delays()):
+            if not self.breaker.allow():
+                STORE_ERRORS.inc(operation, "circuit_open")
+                return None
+            if attempt:
+                STORE_RETRIES.inc(operation)
+            started = time.perf_counter()
+            try:
+                result = await command(*args)
+            except redis.RedisError:
+                STORE_LATENCY.observe(operation, value=time.perf_counter() - started)
+                STORE_ERRORS.inc(operation, "redis")
+                self.breaker.record_failure()
+                logging.error(message)
+            except BaseException:
+                # a half-open probe must not be left unsettled, or every
+                # later call fails fast for good
+                STORE_ERRORS.inc(operation, "unexpected")
+                self.breaker.abandon()
+                raise
+            else:
+                STORE_LATENCY.observe(operation, value=time.perf_counter() - started)
+                self.breaker.record_success()
+                return result
+            if delay is None or time.monotonic() + delay > deadline:
+                return None
+            await asyncio.sleep(delay)
+
+    async def get(self, key):
+        return await self._call("get", "Cannot get value from Redis", self.redis_client.get, key)
+
+    async def get_list(self, key):
+        if self.interests_cache is not None:
+            lists = await self.get_lists([key])
+            return lists[0] if lists is not None else None
+        return await self._call("get_list", "Cannot get list of values from Redis", self.redis_client.lrange, key, 0, -1)
+
+    async def get_lists(self, keys):
+        if self.interests_cache is None:
+            return await self.fetch_lists(keys)
+        names = [self.encoder.encode(key) for key in keys]
+        values = self.interests_cache.lookup(names)
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+        token = self.interests_cache.begin()
+        fetched = None
+        try:
+            fetched = await self.fetch_lists([keys[i] for i in missing])
+        finally:
+            self.interests_cache.finish(token, [names[i] for i in missing], fetched)
+        if fetched is None:
+            return None
+        for i, value in zip(missing, fetched):
+            values[i] = value
+        return values
+
+    async def fetch_lists(self, keys):
+        async def fetch_lists():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.lrange(key, 0, -1)
+            return await pipeline.execute()
+        return await self._call("get_lists", "Cannot get lists of values from Redis", fetch_lists)
+
+    async def get_many(self, keys):
+        if not keys:
+            return []
+        return await self._call("get_many", "Cannot get values from Redis", self.redis_client.mget, keys)
+
+    async def set(self, key, value):
+        return await self._call("set", "Cannot set value to Redis", self.redis_client.set, key, value)
+
+    async def set_list(self, key, value):
+        async def replace_list():
+            await self.redis_client.delete(key)
+            return await self.redis_client.rpush(key, *value)
+        result = await self._call("set_list", "Cannot set value to Redis", replace_list)
+        if self.interests_cache is not None:
+            self.interests_cache.invalidate(self.encoder.encode(key))
+        return result
+
+    async def cache_get(self, key):
+        if self.local_cache is None:
+            return await self._call("cache_get", "Cannot get cached value from Redis", self.redis_client.get, key,
+                                    policy=CACHE_RETRY_POLICY)
+        value = self.local_cache.get(key)
+        if value is not None:
+            return value
+
+        async def fetch_with_ttl():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.get(key)
+            pipeline.ttl(key)
+            return await pipeline.execute()
+        value, ttl = await self._call("cache_get", "Cannot get cached value from Redis", fetch_with_ttl,
+                                      policy=CACHE_RETRY_POLICY) or (None, None)
+        if value is not None and ttl > 0:
+            self.local_cache.set(key, value, ttl)
+        return value
+
+    async def cache_set(self, key, value, expire_timeout):
+        if self.local_cache is not None:
+            self.local_cache.set(key, self.encoder.encode(value), expire_timeout)
+        await self._call("cache_set", "Cannot set cached value to Redis", self.redis_client.set, key, value,
+                         expire_timeout, policy=CACHE_RETRY_POLICY)
+
+    async def cache_get_many(self, keys):
+        if self.local_cache is None:
+            if not keys:
+                return []
+            return await self._call("cache_get_many", "Cannot get cached values from Redis", self.redis_client.mget,
+                                    keys, policy=CACHE_RETRY_POLICY)
+        values = [self.local_cache.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+
+        async def fetch_with_ttl():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for i in missing:
+                pipeline.get(keys[i])
+                pipeline.ttl(keys[i])
+            return await pipeline.execute()
+        result = await self._call("cache_get_many", "Cannot get cached values from Redis", fetch_with_ttl,
+                                  policy=CACHE_RETRY_POLICY)
+        if result is None:
+            return values
+        for i, value, ttl in zip(missing, result[::2], result[1::2]):
+            values[i] = value
+            if value is not None and ttl > 0:
+                self.local_cache.set(keys[i], value, ttl)
+        return values
+
+    async def cache_set_many(self, items, expire_timeout):
+        if self.local_cache is not None:
+            for key, value in items:
+                self.local_cache.set(key, self.encoder.encode(value), expire_timeout)
+        if not items:
+            return
+
+        async def store_values():
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for key, value in items:
+                pipeline.set(key, value, ex=expire_timeout)
+            return await pipeline.execute()
+        await self._call("cache_set_many", "Cannot set cached values to Redis", store_values,
+                         policy=CACHE_RETRY_POLICY)
+
+    async def close(self):
+        if self.interests_cache is not None:
+            self.interests_cache.close()
+        await self.redis_client.close()
+
+
+class AsyncMemoryStore(AsyncBaseStore):
+    # MemoryStore behind the AsyncStore interface; no call ever blocks on I/O
+
+    def __init__(self, connect_params=None, custom_config=None):
+        self.store = MemoryStore(connect_params, custom_config)
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def get_list(self, key):
+        return self.store.get_list(key)
+
+    async def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    async def get_lists(self, keys):
+        return self.store.get_lists(keys)
+
+    async def set(self, key, value):
+        return self.store.set(key, value)
+
+    async def set_list(self, key, value):
+        return self.store.set_list(key, value)
+
+    async def cache_get(self, key):
+        return self.store.cache_get(key)
+
+    async def cache_get_many(self, keys):
+        return self.store.cache_get_many(keys)
+
+    async def cache_set(self, key, value, expire_timeout):
+        self.store.cache_set(key, value, expire_timeout)
+
+    async def cache_set_many(self, items, expire_timeout):
+        self.store.cache_set_many(items, expire_timeout)
+
+
+# the batching wrappers pass everything they don't batch on to the store
+# they wrap
+BaseStore.register(BatchingStore)
+AsyncBaseStore.register(AsyncBatchingStore)
+
+STORES = {
+    "redis": (Store, AsyncStore),
+    "memory": (MemoryStore, AsyncMemoryStore),
+}
+
+
+def make_store(name, connect_params, custom_config, asynchronous=False):
+    store_class = STORES[name][1 if asynchronous else 0]
+    store = store_class(connect_params, custom_config)
+    window = custom_config.get("batch_window", 0)
+    if window > 0:
+        # interests lookups of concurrent requests share pipelined fetches
+        wrapper = AsyncBatchingStore if asynchronous else BatchingStore
+        store = wrapper(store, window, custom_config.get("batch_max_size", 500))
+    return store
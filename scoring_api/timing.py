@@ -0,0 +1,42 @@
+import contextvars
+import time
+
+DEBUG_HEADER = "X-Debug-Timing"
+
+# phase name -> seconds spent, for the request being handled by the current
+# thread (or asyncio task)
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+class span(object):
+    # with span("store"): ... adds the elapsed time to the "store" phase of
+    # the current request; a no-op outside of a request
+    __slots__ = ("name", "timings", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _timings.get()
+        if self.timings is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            elapsed = time.perf_counter() - self.started
+            self.timings[self.name] = self.timings.get(self.name, 0.0) + elapsed
+        return False
+
+
+def start(ctx):
+    timings = ctx["timings"] = {}
+    return _timings.set(timings)
+
+
+def stop(token):
+    _timings.reset(token)
+
+
+def server_timing(timings):
+    return ", ".join("%s;dur=%.3f" % (name, seconds * 1000) for name, seconds in timings.items())
@@ -0,0 +1,123 @@
+import asyncio
+import time
+import unittest
+
+import redis
+
+from scoring_api import api
+from scoring_api import scoring
+from scoring_api import store
+
+
+def redis_available():
+    try:
+        return redis.Redis(**dict(api.REDIS_CONFIG, socket_connect_timeout=0.5)).ping()
+    except redis.RedisError:
+        return False
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@unittest.skipUnless(redis_available(), "needs a redis-server on localhost:6379")
+class TestInterestsCache(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store(api.REDIS_CONFIG, dict(api.REDIS_CUSTOM_CONFIG, interests_cache_size=100,
+                                                        interests_cache_ttl=60, interests_cache_configure=True))
+        # an external writer, bypassing the cache
+        self.writer = redis.Redis(**api.REDIS_CONFIG)
+        self.writer.delete("1", "2")
+        self.writer.rpush("1", "Sport", "Books")
+        self.store.get_lists(["1"])
+        self.assertTrue(wait_for(lambda: self.store.interests_cache.listening))
+
+    def tearDown(self):
+        self.writer.delete("1", "2")
+        self.writer.close()
+        self.store.close()
+
+    def stats(self):
+        return self.store.interests_cache_stats()
+
+    def test_reads_are_served_locally(self):
+        self.assertEqual(["Sport", "Books"], scoring.get_interests(self.store, "1"))
+        hits = self.stats()["hits"]
+        self.assertEqual(["Sport", "Books"], scoring.get_interests(self.store, "1"))
+        self.assertEqual([["Sport", "Books"], []], scoring.get_interests_bulk(self.store, ["1", "2"]))
+        self.assertEqual(hits + 2, self.stats()["hits"])
+
+    def test_set_list_invalidates(self):
+        scoring.get_interests(self.store, "1")
+        self.store.set_list("1", ["Travel"])
+        self.assertEqual(["Travel"], scoring.get_interests(self.store, "1"))
+
+    def test_external_write_invalidates(self):
+        scoring.get_interests(self.store, "1")
+        scoring.get_interests(self.store, "2")
+        self.writer.rpush("1", "Travel")
+        self.writer.rpush("2", "Music")
+        self.assertTrue(wait_for(lambda: scoring.get_interests(self.store, "1") == ["Sport", "Books", "Travel"]))
+        self.assertTrue(wait_for(lambda: scoring.get_interests(self.store, "2") == ["Music"]))
+        self.writer.expire("1", 0)
+        self.assertTrue(wait_for(lambda: scoring.get_interests(self.store, "1") == []))
+
+    def test_score_writes_are_not_listened_to(self):
+        invalidations = self.stats()["invalidations"]
+        scoring.get_score(self.store, "79175002040", "stupnikov@otus.ru")
+        self.writer.set("uid:test", 1.5, ex=60)
+        self.writer.rpush("2", "Music")
+        self.assertTrue(wait_for(lambda: self.stats()["invalidations"] > invalidations))
+        time.sleep(0.05)
+        self.assertEqual(invalidations + 1, self.stats()["invalidations"])
+        self.writer.delete("uid:test")
+
+    def test_dropped_subscription_clears_cache(self):
+        scoring.get_interests(self.store, "1")
+        resets = self.stats()["resets"]
+        self.writer.client_kill_filter(_type="pubsub")
+        # whether redis-py resubscribes by itself or the listener does, the
+        # cache starts over
+        self.assertTrue(wait_for(lambda: self.stats()["resets"] > resets and self.stats()["listening"], timeout=5))
+        self.assertEqual(0, self.stats()["size"])
+        self.writer.rpush("1", "Travel")
+        self.assertTrue(wait_for(lambda: scoring.get_interests(self.store, "1") == ["Sport", "Books", "Travel"]))
+
+    def test_fallback_ttl(self):
+        self.store.interests_cache.ttl = 0.05
+        scoring.get_interests(self.store, "1")
+        # the notification of this write gets lost
+        self.store.interests_cache.invalidate = lambda key: None
+        self.writer.rpush("1", "Travel")
+        time.sleep(0.1)
+        self.assertEqual(["Sport", "Books", "Travel"], scoring.get_interests(self.store, "1"))
+
+
+@unittest.skipUnless(redis_available(), "needs a redis-server on localhost:6379")
+class TestAsyncInterestsCache(unittest.IsolatedAsyncioTestCase):
+    async def test_external_write_invalidates(self):
+        custom_config = dict(api.REDIS_CUSTOM_CONFIG, interests_cache_size=100, interests_cache_configure=True)
+        s = store.AsyncStore(api.REDIS_CONFIG, custom_config)
+        writer = redis.Redis(**api.REDIS_CONFIG)
+        writer.delete("1")
+        await s.set_list("1", ["Sport"])
+        await s.get_list("1")
+        self.assertTrue(wait_for(lambda: s.interests_cache.listening))
+        self.assertEqual(["Sport"], await scoring.get_interests_async(s, "1"))
+        writer.rpush("1", "Books")
+        deadline = time.monotonic() + 2
+        while await scoring.get_interests_async(s, "1") != ["Sport", "Books"]:
+            self.assertLess(time.monotonic(), deadline)
+            await asyncio.sleep(0.01)
+        writer.delete("1")
+        writer.close()
+        await s.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
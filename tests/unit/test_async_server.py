@@ -0,0 +1,131 @@
+import asyncio
+import json
+import unittest
+
+from scoring_api import api
+from scoring_api import async_api
+from scoring_api.store import AsyncStore
+
+
+class TestAsyncHTTPServer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store = AsyncStore(api.REDIS_CONFIG,
+                                api.REDIS_CUSTOM_CONFIG)
+        server = async_api.AsyncHTTPServer(self.store)
+        self.listener = await asyncio.start_server(server.handle_connection,
+                                                   "localhost", 0)
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.listener.close()
+        await self.listener.wait_closed()
+        await self.store.close()
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.lower()] = value.strip()
+        body = await reader.readexactly(int(headers["content-length"]))
+        return int(status_line.split()[1]), headers, json.loads(body)
+
+    def make_request(self, body, path="/method/", connection="keep-alive"):
+        data = json.dumps(body).encode()
+        head = ("POST %s HTTP/1.1\r\nHost: localhost\r\n"
+                "Content-Length: %d\r\nConnection: %s\r\n\r\n"
+                % (path, len(data), connection))
+        return head.encode() + data
+
+    async def test_requests_over_one_connection(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        for _ in range(3):
+            writer.write(self.make_request(request))
+            code, headers, body = await self.read_response(reader)
+            self.assertEqual(api.FORBIDDEN, code)
+            self.assertEqual(api.FORBIDDEN, body["code"])
+            self.assertEqual("keep-alive", headers["connection"])
+        writer.close()
+
+    async def test_pipelined_requests(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(self.make_request(request) * 3)
+        for _ in range(3):
+            code, _, body = await self.read_response(reader)
+            self.assertEqual(api.FORBIDDEN, code)
+        writer.close()
+
+    async def test_connection_close(self):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(self.make_request({"method": "online_score"},
+                                       path="/unknown/", connection="close"))
+        code, headers, _ = await self.read_response(reader)
+        self.assertEqual(api.NOT_FOUND, code)
+        self.assertEqual("close", headers["connection"])
+        self.assertEqual(b"", await reader.read())
+        writer.close()
+
+    async def test_malformed_request(self):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(b"GARBAGE\r\n\r\n")
+        code, _, body = await self.read_response(reader)
+        self.assertEqual(api.BAD_REQUEST, code)
+        self.assertEqual(api.BAD_REQUEST, body["code"])
+        writer.close()
+
+    async def test_server_timing(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        data = json.dumps(request).encode()
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(("POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n"
+                      "X-Debug-Timing: 1\r\n\r\n" % len(data)).encode() + data)
+        code, headers, _ = await self.read_response(reader)
+        self.assertEqual(api.FORBIDDEN, code)
+        self.assertIn("auth;dur=", headers["server-timing"])
+        self.assertIn("total;dur=", headers["server-timing"])
+        writer.close()
+
+    async def test_too_large(self):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(b"POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (api.MAX_BODY_SIZE + 1))
+        code, headers, body = await self.read_response(reader)
+        self.assertEqual(api.REQUEST_TOO_LARGE, code)
+        self.assertEqual("close", headers["connection"])
+        writer.close()
+
+    async def test_invalid_json(self):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(b"POST /method/ HTTP/1.1\r\nContent-Length: 3\r\n\r\n{x}")
+        code, _, _ = await self.read_response(reader)
+        self.assertEqual(api.BAD_REQUEST, code)
+        writer.close()
+
+    async def test_empty_batch(self):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(self.make_request([], path="/batch/"))
+        code, _, body = await self.read_response(reader)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual(["Batch is empty"], body["error"])
+        writer.close()
+
+    async def test_batch_too_large(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        writer.write(self.make_request([request] * (api.MAX_BATCH_REQUESTS + 1), path="/batch/"))
+        code, _, body = await self.read_response(reader)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual(["No more than %d requests per batch" % api.MAX_BATCH_REQUESTS], body["error"])
+        writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import datetime
+import hashlib
+import unittest
+
+from scoring_api import api
+from tests.case_decorator import cases
+
+
+def admin_token(moment):
+    return hashlib.sha512((moment.strftime("%Y%m%d%H") + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+
+
+def make_request(login, token, account="horns&hoofs"):
+    return api.MethodRequest({"account": account, "login": login, "token": token})
+
+
+class TestCheckAuth(unittest.TestCase):
+    def setUp(self):
+        self.auth_cache = api.AUTH_CACHE
+        api.AUTH_CACHE = api.AuthCache(max_size=2, grace=60)
+
+    def tearDown(self):
+        api.AUTH_CACHE = self.auth_cache
+
+    def test_user_token(self):
+        token = hashlib.sha512(("horns&hoofs" + "h&f" + api.SALT).encode('utf-8')).hexdigest()
+        self.assertTrue(api.check_auth(make_request("h&f", token)))
+        self.assertTrue(api.check_auth(make_request("h&f", token)))
+        self.assertIn(("horns&hoofs", "h&f"), api.AUTH_CACHE.digests)
+
+    @cases([None, "", "sdd", 42, "ключ"])
+    def test_bad_user_token(self, token):
+        self.assertFalse(api.check_auth(make_request("h&f", token)))
+        self.assertEqual(0, len(api.AUTH_CACHE.digests))
+
+    def test_cache_is_bounded(self):
+        for login in ("a", "b", "c"):
+            token = api.user_digest("horns&hoofs", login)
+            self.assertTrue(api.check_auth(make_request(login, token)))
+        self.assertEqual([("horns&hoofs", "b"), ("horns&hoofs", "c")], list(api.AUTH_CACHE.digests))
+
+    def test_admin_token(self):
+        now = datetime.datetime(2023, 5, 1, 12, 30)
+        self.assertTrue(api.check_auth(make_request(api.ADMIN_LOGIN, admin_token(now)), now))
+        self.assertFalse(api.check_auth(make_request(api.ADMIN_LOGIN, admin_token(now)[:-1]), now))
+
+    def test_admin_grace_window(self):
+        previous = datetime.datetime(2023, 5, 1, 11, 59, 50)
+        token = admin_token(previous)
+        in_grace = datetime.datetime(2023, 5, 1, 12, 0, 30)
+        after_grace = datetime.datetime(2023, 5, 1, 12, 1, 30)
+        self.assertTrue(api.check_auth(make_request(api.ADMIN_LOGIN, token), in_grace))
+        self.assertFalse(api.check_auth(make_request(api.ADMIN_LOGIN, token), after_grace))
+        self.assertTrue(api.check_auth(make_request(api.ADMIN_LOGIN, admin_token(after_grace)), after_grace))
+
+
+if __name__ == "__main__":
+    unittest.main()
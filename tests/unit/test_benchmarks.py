@@ -0,0 +1,29 @@
+import unittest
+
+from benchmarks import suite
+
+
+class TestSuite(unittest.TestCase):
+    def test_cases_run(self):
+        names = set()
+        for name, fn in suite.all_cases():
+            self.assertNotIn(name, names)
+            names.add(name)
+            fn()
+
+    def test_run(self):
+        results = suite.run(suite.field_cases()[:1], repeat=1, min_time=0.001)
+        [(name, result)] = results.items()
+        self.assertEqual("CharField.validate", name)
+        self.assertGreater(result["number"], 1)
+        self.assertGreater(result["us_per_op"], 0)
+
+    def test_compare(self):
+        baseline = {"a": {"us_per_op": 10.0}, "b": {"us_per_op": 10.0}}
+        results = {"a": {"us_per_op": 11.0}, "b": {"us_per_op": 13.0}, "c": {"us_per_op": 1.0}}
+        self.assertEqual([("a", 10.0, 11.0, False), ("b", 10.0, 13.0, True)],
+                         suite.compare(results, baseline, 0.2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import io
+import json
+import unittest
+
+from scoring_api import api
+from scoring_api import bulk
+from scoring_api import store
+from tests.case_decorator import cases
+
+
+def make_input(n):
+    lines = []
+    for i in range(n):
+        if i % 3 == 0:
+            lines.append(json.dumps({"phone": "123"}))
+        else:
+            lines.append(json.dumps({"phone": "7917%07d" % i, "email": "a@b.ru", "gender": 1,
+                                     "birthday": "01.01.2000"}))
+    return "\n".join(lines) + "\n"
+
+
+class TestBulk(unittest.TestCase):
+    @cases([
+        ('{"phone": "79175002040", "email": "stupnikov@otus.ru"}', {"score": 3.0}, api.OK),
+        ('{"first_name": "a", "last_name": "b", "gender": 1, "birthday": "01.01.2000"}', {"score": 2.0}, api.OK),
+        ('{"phone": "79175002040"}', ["Required pairs don't exist"], api.INVALID_REQUEST),
+        ('["phone"]', ["Record must be an object"], api.INVALID_REQUEST),
+        ('{"phone": ', None, api.BAD_REQUEST),
+    ])
+    def test_score_record(self, line, response, code):
+        self.assertEqual((response, code), bulk.score_record(line, store.MemoryStore()))
+
+    def test_read_chunks(self):
+        lines = ["1\n", "\n", "2\n", "3\n", "  \n", "4\n", "5\n"]
+        self.assertEqual([["1\n", "2\n"], ["3\n", "4\n"], ["5\n"]], list(bulk.read_chunks(lines, 2)))
+
+    def test_run_in_process(self):
+        output = io.StringIO()
+        stats = bulk.run(io.StringIO(make_input(10)), output, workers=1, chunk_size=3, store="memory")
+        self.assertEqual({"records": 10, "errors": 4}, stats)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(10, len(results))
+        self.assertEqual(api.INVALID_REQUEST, results[0]["code"])
+        self.assertEqual({"response": {"score": 4.5}, "code": api.OK}, results[1])
+
+    def test_pool_keeps_input_order(self):
+        data = make_input(500)
+        expected = io.StringIO()
+        bulk.run(io.StringIO(data), expected, workers=1, chunk_size=7, store="memory")
+        output = io.StringIO()
+        stats = bulk.run(io.StringIO(data), output, workers=2, chunk_size=7, store="memory", window=3)
+        self.assertEqual(500, stats["records"])
+        self.assertEqual(expected.getvalue(), output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
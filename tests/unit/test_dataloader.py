@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import unittest
+
+from scoring_api import scoring
+from scoring_api import store
+from scoring_api.dataloader import AsyncBatchingStore, AsyncListLoader, BatchingStore, ListLoader
+
+
+class CountingStore(store.MemoryStore):
+    def __init__(self):
+        super(CountingStore, self).__init__()
+        self.fetches = []
+        for cid in range(10):
+            self.set_list(cid, ["interest%d" % cid])
+
+    def get_lists(self, keys):
+        self.fetches.append(list(keys))
+        return super(CountingStore, self).get_lists(keys)
+
+
+class TestListLoader(unittest.TestCase):
+    def run_concurrently(self, s, requests):
+        results = {}
+
+        def worker(i, cids):
+            results[i] = scoring.get_interests_bulk(s, cids)
+
+        threads = [threading.Thread(target=worker, args=(i, cids)) for i, cids in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[i] for i in range(len(requests))]
+
+    def test_concurrent_requests_share_fetch(self):
+        counting = CountingStore()
+        s = BatchingStore(counting, window=0.05)
+        requests = [[1, 2], [2, 3], [4], [1]]
+        results = self.run_concurrently(s, requests)
+        self.assertEqual([[["interest%d" % cid] for cid in cids] for cids in requests], results)
+        self.assertEqual([[1, 2, 3, 4]], counting.fetches)
+
+    def test_max_batch(self):
+        counting = CountingStore()
+        s = BatchingStore(counting, window=5, max_batch=3)
+        results = self.run_concurrently(s, [[1, 2, 3]])
+        self.assertEqual([[["interest1"], ["interest2"], ["interest3"]]], results)
+        self.assertEqual([[1, 2, 3]], counting.fetches)
+
+    def test_get_list_and_passthrough(self):
+        counting = CountingStore()
+        s = BatchingStore(counting, window=0)
+        self.assertEqual([b"interest1"], s.get_list(1))
+        self.assertEqual([], scoring.get_interests(s, 42))
+        s.set("key", 1)
+        self.assertEqual(b"1", s.get("key"))
+
+    def test_failed_fetch(self):
+        loader = ListLoader(lambda keys: None, window=0)
+        self.assertIsNone(loader.load_many([1]))
+
+    def test_fetch_error(self):
+        def fetch(keys):
+            raise ValueError("boom")
+
+        loader = ListLoader(fetch, window=0)
+        with self.assertLogs(level="ERROR"):
+            self.assertIsNone(loader.load_many([1]))
+
+
+class TestAsyncListLoader(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_requests_share_fetch(self):
+        counting = CountingStore()
+        s = AsyncBatchingStore(store.AsyncMemoryStore(), window=0.01)
+        s.store.store = counting
+        requests = [[1, 2], [2, 3], [4], [1]]
+        results = await asyncio.gather(*[scoring.get_interests_bulk_async(s, cids) for cids in requests])
+        self.assertEqual([[["interest%d" % cid] for cid in cids] for cids in requests], results)
+        self.assertEqual([[1, 2, 3, 4]], counting.fetches)
+        self.assertEqual(["interest5"], await scoring.get_interests_async(s, 5))
+        self.assertEqual(2, len(counting.fetches))
+
+    async def test_max_batch(self):
+        fetches = []
+
+        async def fetch(keys):
+            fetches.append(list(keys))
+            return [[key] for key in keys]
+
+        loader = AsyncListLoader(fetch, window=5, max_batch=2)
+        results = await asyncio.wait_for(asyncio.gather(loader.load_many([1]), loader.load_many([2, 3]),
+                                                        loader.load_many([4, 5])), 1)
+        self.assertEqual([[[1]], [[2], [3]], [[4], [5]]], results)
+        self.assertEqual([[1, 2, 3], [4, 5]], fetches)
+
+    async def test_failed_fetch(self):
+        async def fetch(keys):
+            raise ValueError("boom")
+
+        loader = AsyncListLoader(fetch, window=0)
+        with self.assertLogs(level="ERROR"):
+            results = await asyncio.gather(loader.load_many([1]), loader.load_many([2]))
+        self.assertEqual([None, None], results)
+
+
+class TestMakeStore(unittest.TestCase):
+    def test_batch_window(self):
+        self.assertIsInstance(store.make_store("memory", {}, {"batch_window": 0.001}), BatchingStore)
+        self.assertIsInstance(store.make_store("memory", {}, {"batch_window": 0.001}, asynchronous=True),
+                              AsyncBatchingStore)
+        self.assertIsInstance(store.make_store("memory", {}, {"batch_window": 0}), store.MemoryStore)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import json
+import threading
+import unittest
+
+from benchmarks import loadgen
+from scoring_api import api
+from scoring_api import store
+from tests.case_decorator import cases
+
+REQUEST = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "",
+           "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}
+
+
+class TestCorpus(unittest.TestCase):
+    @cases([
+        (json.dumps(REQUEST), ("/method/", REQUEST)),
+        (json.dumps([REQUEST]), ("/batch/", [REQUEST])),
+        (json.dumps({"path": "/method/", "body": REQUEST}), ("/method/", REQUEST)),
+        ("[2026.10.18 04:45:48] I /method/: %r 5e2c" % json.dumps(REQUEST).encode(), ("/method/", REQUEST)),
+        (json.dumps({"msg": "request", "path": "/batch/", "body": [REQUEST], "code": None}),
+         ("/batch/", [REQUEST])),
+    ])
+    def test_parse_line(self, line, expected):
+        self.assertEqual(expected, loadgen.parse_line(line))
+
+    @cases([
+        "",
+        "not json",
+        "[2026.10.18 04:45:48] I {'request_id': '5e2c', 'code': 200}",
+        json.dumps({"request_id": "user-001", "title": "x"}),
+        json.dumps({"msg": "request", "path": "/method/", "body": '{"account": "h...(120 more)'}),
+        json.dumps({"msg": "response", "path": "/method/", "context": {"code": 200}}),
+        "42",
+    ])
+    def test_not_a_request(self, line):
+        self.assertIsNone(loadgen.parse_line(line))
+
+    def test_sign(self):
+        for login in ("h&f", api.ADMIN_LOGIN):
+            signed = loadgen.sign(dict(REQUEST, login=login))
+            self.assertTrue(api.check_auth(api.OnlineScoreRequest(signed)))
+        self.assertEqual("", REQUEST["token"])
+
+    def test_percentile(self):
+        ordered = list(range(1, 1001))
+        self.assertEqual(500, loadgen.percentile(ordered, 50))
+        self.assertEqual(990, loadgen.percentile(ordered, 99))
+        self.assertEqual(999, loadgen.percentile(ordered, 99.9))
+        self.assertEqual(1, loadgen.percentile([1], 99.9))
+        self.assertEqual(0.0, loadgen.percentile([], 50))
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.saved, api.STORE = api.STORE, store.MemoryStore()
+        self.server = api.make_server(("localhost", 0), threads=4)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.corpus = loadgen.sign_corpus([("/method/", REQUEST), ("/method/", dict(REQUEST, arguments={})),
+                                           ("/batch/", [REQUEST])])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        api.STORE = self.saved
+
+    def test_closed_loop(self):
+        results = loadgen.run_closed(self.corpus, *self.server.server_address, concurrency=3, total=30)
+        report = results.report()
+        self.assertEqual(30, report["requests"])
+        self.assertEqual({"200": 20, "422": 10}, report["codes"])
+        self.assertEqual(["p50", "p95", "p99", "p99.9"], list(report["latency_ms"]))
+
+    def test_open_loop(self):
+        results = loadgen.run_open(self.corpus, *self.server.server_address, concurrency=2, rate=200, total=20)
+        report = results.report()
+        self.assertEqual(20, report["requests"])
+        self.assertGreaterEqual(report["duration"], 19 / 200.0)
+        # the corpus is replayed in order, one request per scheduled start
+        self.assertEqual({"200": 13, "422": 7}, report["codes"])
+
+    def test_connection_errors(self):
+        results = loadgen.run_closed(self.corpus, "localhost", 1, concurrency=1, total=2)
+        self.assertEqual({"error": 2}, results.report()["codes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import io
+import json
+import logging
+import queue
+import unittest
+import uuid
+
+from scoring_api import logs
+
+
+def make_record(code=None, request_id=None, level=logging.INFO, msg="%s", args=("message",)):
+    record = logging.LogRecord("test", level, __file__, 1, msg, args, None)
+    if code is not None:
+        record.code = code
+        record.request_id = request_id or uuid.uuid4().hex
+    return record
+
+
+class TestPayload(unittest.TestCase):
+    def tearDown(self):
+        logs.MAX_PAYLOAD = 0
+
+    def test_truncation(self):
+        logs.MAX_PAYLOAD = 5
+        self.assertEqual("abcde...(3 more)", str(logs.Payload("abcdefgh")))
+        self.assertEqual("abc", str(logs.Payload("abc")))
+
+    def test_whole_payload(self):
+        self.assertEqual("b'abcdefgh'", str(logs.Payload(b"abcdefgh")))
+
+
+class TestSamplingFilter(unittest.TestCase):
+    def test_keeps_errors_and_plain_records(self):
+        sampling = logs.SamplingFilter(rate=0)
+        self.assertTrue(sampling.filter(make_record()))
+        self.assertTrue(sampling.filter(make_record(code=500)))
+        self.assertTrue(sampling.filter(make_record(code=422)))
+        self.assertTrue(sampling.filter(make_record(code=200, level=logging.ERROR)))
+        self.assertFalse(sampling.filter(make_record(code=200)))
+
+    def test_sample_rate(self):
+        sampling = logs.SamplingFilter(rate=0.25)
+        kept = sum(sampling.filter(make_record(code=200)) for _ in range(4000))
+        self.assertTrue(700 < kept < 1300, kept)
+
+    def test_same_decision_per_request(self):
+        sampling = logs.SamplingFilter(rate=0.5)
+        for _ in range(100):
+            request_id = uuid.uuid4().hex
+            self.assertEqual(sampling.filter(make_record(code=200, request_id=request_id)),
+                             sampling.filter(make_record(code=200, request_id=request_id)))
+
+
+class TestJsonFormatter(unittest.TestCase):
+    def test_format(self):
+        record = make_record(code=200, request_id="abc", msg="%s: %s", args=("/method/", logs.Payload({"a": 1})))
+        record.path = "/method/"
+        entry = json.loads(logs.JsonFormatter().format(record))
+        self.assertEqual("/method/: {'a': 1}", entry["msg"])
+        self.assertEqual("abc", entry["request_id"])
+        self.assertEqual(200, entry["code"])
+        self.assertEqual("INFO", entry["level"])
+
+
+class TestLogRequest(unittest.TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = logging.StreamHandler(self.stream)
+        root = logging.getLogger()
+        root.addHandler(self.handler)
+        self.addCleanup(root.removeHandler, self.handler)
+        self.addCleanup(root.setLevel, root.level)
+        root.setLevel(logging.INFO)
+        self.body = json.dumps({"method": "online_score", "arguments": {"first_name": "Кирилл"}}).encode()
+        self.context = {"request_id": "abc", "code": 200, "response": {"score": 3.0}, "timings": {"read": 0.5}}
+
+    def tearDown(self):
+        logs.MAX_PAYLOAD = 0
+
+    def log(self, formatter):
+        self.handler.setFormatter(formatter)
+        logs.log_request("/method/", self.body, self.context)
+        return self.stream.getvalue().splitlines()
+
+    def test_json_fields(self):
+        request, response = [json.loads(line) for line in self.log(logs.JsonFormatter())]
+        self.assertEqual("request", request["msg"])
+        self.assertEqual(json.loads(self.body), request["body"])
+        self.assertEqual(("abc", "/method/", 200), (request["request_id"], request["path"], request["code"]))
+        self.assertEqual("response", response["msg"])
+        self.assertEqual(self.context, response["context"])
+
+    def test_json_truncation(self):
+        logs.MAX_PAYLOAD = 10
+        request, response = [json.loads(line) for line in self.log(logs.JsonFormatter())]
+        self.assertTrue(request["body"].startswith('{"method":'))
+        self.assertTrue(response["context"].startswith('{"request_'))
+
+    def test_plain_message(self):
+        request, response = self.log(logging.Formatter("%(message)s"))
+        self.assertEqual("/method/: %r abc" % self.body, request)
+        self.assertEqual(str(self.context), response)
+
+
+class TestLazyQueueHandler(unittest.TestCase):
+    def test_enqueues_unformatted_and_drops_when_full(self):
+        handler = logs.LazyQueueHandler(queue.Queue(1))
+        first, second = make_record(), make_record()
+        handler.handle(first)
+        handler.handle(second)
+        record = handler.queue.get_nowait()
+        self.assertIs(first, record)
+        self.assertEqual(("message",), record.args)
+        self.assertEqual(1, handler.dropped)
+
+    def test_payload_is_snapshotted(self):
+        handler = logs.LazyQueueHandler(queue.Queue())
+        context = {"code": 200, "timings": {"read": 1.0}}
+        handler.handle(make_record(msg="%s", args=(logs.Payload(context),)))
+        context["timings"]["total"] = 2.0
+        context["code"] = 500
+        record = handler.queue.get_nowait()
+        self.assertEqual(str({"code": 200, "timings": {"read": 1.0}}), record.getMessage())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import threading
+import unittest
+
+from scoring_api import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter_across_threads(self):
+        counter = self.registry.counter("requests_total", "Requests", ("method",))
+
+        def work():
+            for _ in range(1000):
+                counter.inc("online_score")
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc("clients_interests", amount=2)
+        self.assertEqual({("online_score",): 4000, ("clients_interests",): 2}, counter.values())
+        text = self.registry.render()
+        self.assertIn("# TYPE requests_total counter", text)
+        self.assertIn('requests_total{method="online_score"} 4000', text)
+
+    def test_gauge(self):
+        gauge = self.registry.gauge("in_flight", "In flight")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertIn("in_flight 1", self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("latency_seconds", "Latency", ("method",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe("m", value=value)
+        lines = self.registry.render().splitlines()
+        self.assertIn('latency_seconds_bucket{method="m",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{method="m",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{method="m",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count{method="m"} 4', lines)
+        self.assertIn('latency_seconds_sum{method="m"} 3.65', lines)
+
+    def test_callback_gauge(self):
+        self.registry.callback_gauge("pool", "Pool", ("state",), lambda: {("idle",): 3})
+        self.assertIn('pool{state="idle"} 3', self.registry.render())
+
+    def test_label_escaping(self):
+        counter = self.registry.counter("c", "C", ("path",))
+        counter.inc('a"b')
+        self.assertIn('c{path="a\\"b"} 1', self.registry.render())
+
+    def test_const_labels(self):
+        self.registry.const_labels = (("pid", 7),)
+        self.registry.gauge("in_flight", "In flight").inc()
+        self.registry.histogram("latency_seconds", "Latency", ("method",), buckets=(1.0,)).observe("m", value=0.5)
+        lines = self.registry.render().splitlines()
+        self.assertIn('in_flight{pid="7"} 1', lines)
+        self.assertIn('latency_seconds_bucket{method="m",pid="7",le="1.0"} 1', lines)
+        self.assertIn('latency_seconds_count{method="m",pid="7"} 1', lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
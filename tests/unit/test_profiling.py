@@ -0,0 +1,70 @@
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+
+from scoring_api import profiling
+
+
+def work(n):
+    return sum(range(n))
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.profiler = profiling.Profiler(self.directory.name, rate=3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sampling_rate(self):
+        for _ in range(9):
+            self.assertEqual(45, self.profiler.run("online_score", {}, work, 10))
+        self.assertEqual(3, self.profiler.summary()["profiled"])
+
+    def test_disabled_sampling(self):
+        profiler = profiling.Profiler(self.directory.name)
+        for _ in range(5):
+            profiler.run("online_score", {}, work, 10)
+        self.assertEqual(0, profiler.summary()["profiled"])
+
+    def test_trigger_header(self):
+        profiler = profiling.Profiler(self.directory.name)
+        profiler.run("online_score", {profiling.TRIGGER_HEADER: "1"}, work, 10)
+        self.assertEqual(1, profiler.summary()["profiled"])
+
+    def test_busy_profiler_is_skipped(self):
+        headers = {profiling.TRIGGER_HEADER: "1"}
+        entered, release = threading.Event(), threading.Event()
+
+        def slow():
+            entered.set()
+            release.wait(5)
+
+        thread = threading.Thread(target=self.profiler.run, args=("online_score", headers, slow))
+        thread.start()
+        entered.wait(5)
+        self.assertEqual(45, self.profiler.run("online_score", headers, work, 10))
+        release.set()
+        thread.join()
+        self.assertEqual(1, self.profiler.summary()["profiled"])
+        self.assertEqual(1, self.profiler.summary()["skipped"])
+
+    def test_dump_per_method(self):
+        headers = {profiling.TRIGGER_HEADER: "1"}
+        self.profiler.run("online_score", headers, work, 10)
+        self.profiler.run("online_score", headers, work, 10)
+        self.profiler.run("clients_interests", headers, work, 10)
+        paths = self.profiler.dump()
+        self.assertEqual(["clients_interests", "online_score"],
+                         [os.path.basename(path).split("-")[0] for path in paths])
+        stats = pstats.Stats(paths[1])
+        calls = [value[1] for func, value in stats.stats.items() if func[2] == "work"]
+        self.assertEqual([2], calls)
+        self.assertEqual([], self.profiler.summary()["methods"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -91,5 +91,29 @@ class TestOnlineScoreRequest(unittest.TestCase):
         self.assertFalse(success)
 
 
+class TestRequestSchema(unittest.TestCase):
+    def test_fields_compiled_once(self):
+        self.assertEqual(["account", "login", "token", "arguments", "method"], api.MethodRequest.request_fields)
+        self.assertEqual(["client_ids", "date"], api.ClientsInterestsRequest.fields)
+        self.assertEqual(["first_name", "last_name", "email", "phone", "birthday", "gender"],
+                         api.OnlineScoreRequest.fields)
+        self.assertIsInstance(api.OnlineScoreRequest.schema["phone"], api.PhoneField)
+        self.assertIsInstance(api.OnlineScoreRequest.schema["login"], api.CharField)
+
+    def test_slots_storage(self):
+        request = api.OnlineScoreRequest({"login": "h&f", "arguments": {"phone": "79175002040"}})
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual("79175002040", request.phone)
+        self.assertIsNone(request.email)
+        self.assertIsNone(request.token)
+
+    def test_arguments_not_dict(self):
+        request = api.OnlineScoreRequest({"login": "h&f", "token": "", "method": "online_score",
+                                          "arguments": ["phone"]})
+        success, errors = request.isvalid()
+        self.assertFalse(success)
+        self.assertIsNone(request.phone)
+
+
 if __name__ == "__main__":
     unittest.main()
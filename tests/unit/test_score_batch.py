@@ -0,0 +1,194 @@
+import datetime
+import unittest
+
+from scoring_api import api
+from scoring_api import async_api
+from scoring_api import scoring
+from scoring_api import store
+from tests.case_decorator import cases
+
+PROFILES = [
+    {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    {"phone": "79175002040"},
+    "not a profile",
+    {"first_name": "a", "last_name": "b"},
+    {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    {"gender": 0, "birthday": "01.01.2000"},
+    {"phone": 79175002041, "email": "a@b.ru", "gender": 1, "birthday": "01.01.2000", "first_name": "a",
+     "last_name": "b"},
+]
+
+
+def make_request(profiles, login="h&f"):
+    token = (api.admin_digest(datetime.datetime.now()) if login == api.ADMIN_LOGIN
+             else api.user_digest("horns&hoofs", login))
+    return {"body": {"account": "horns&hoofs", "login": login, "method": "online_score_batch", "token": token,
+                     "arguments": {"profiles": profiles}}}
+
+
+class CountingStore(store.MemoryStore):
+    def __init__(self):
+        super(CountingStore, self).__init__()
+        self.calls = []
+
+    def cache_get_many(self, keys):
+        self.calls.append(("cache_get_many", len(keys)))
+        return super(CountingStore, self).cache_get_many(keys)
+
+    def cache_set_many(self, items, expire_timeout):
+        self.calls.append(("cache_set_many", len(items)))
+        super(CountingStore, self).cache_set_many(items, expire_timeout)
+
+    def get_lists(self, keys):
+        self.calls.append(("get_lists", len(keys)))
+        return super(CountingStore, self).get_lists(keys)
+
+
+def method_request(method, arguments, login="h&f"):
+    request = make_request(None, login)["body"]
+    return dict(request, method=method, arguments=arguments)
+
+
+def mixed_batch():
+    return [
+        method_request("online_score", PROFILES[0]),
+        method_request("clients_interests", {"client_ids": [1, 3]}),
+        method_request("online_score", PROFILES[3]),
+        method_request("online_score", PROFILES[1]),
+        method_request("online_score", PROFILES[0], login=api.ADMIN_LOGIN),
+        method_request("clients_interests", {"client_ids": [2, 1]}),
+        dict(method_request("online_score", PROFILES[0]), token="bad"),
+    ]
+
+
+class TestBatchHandler(unittest.TestCase):
+    def setUp(self):
+        self.store = CountingStore()
+        self.store.set_list(1, ["Sport"])
+        self.store.set_list(2, ["Books"])
+
+    def test_elements_share_store_round_trips(self):
+        response, code = api.batch_handler({"body": mixed_batch()}, {"request_id": "1"}, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([
+            {"response": {"score": 3.0}, "code": api.OK},
+            {"response": {1: ["Sport"], 3: []}, "code": api.OK},
+            {"response": {"score": 0.5}, "code": api.OK},
+            {"error": ["Required pairs don't exist"], "code": api.INVALID_REQUEST},
+            {"response": {"score": 42}, "code": api.OK},
+            {"response": {2: ["Books"], 1: ["Sport"]}, "code": api.OK},
+            {"error": "Forbidden", "code": api.FORBIDDEN},
+        ], response)
+        self.assertEqual([("cache_get_many", 2), ("cache_set_many", 2), ("get_lists", 3)], self.store.calls)
+
+    @cases([[], list(range(api.MAX_BATCH_REQUESTS + 1)), {}])
+    def test_invalid_batch(self, body):
+        _, code = api.batch_handler({"body": body}, {"request_id": "1"}, self.store)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class TestAsyncBatchHandler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.store = store.AsyncMemoryStore()
+        self.store.store = CountingStore()
+        self.store.store.set_list(1, ["Sport"])
+        self.store.store.set_list(2, ["Books"])
+
+    async def test_elements_share_store_round_trips(self):
+        sync_store = CountingStore()
+        sync_store.set_list(1, ["Sport"])
+        sync_store.set_list(2, ["Books"])
+        expected = api.batch_handler({"body": mixed_batch()}, {"request_id": "1"}, sync_store)
+        response = await async_api.batch_handler({"body": mixed_batch()}, {"request_id": "1"}, self.store)
+        self.assertEqual(expected, response)
+        self.assertEqual([("cache_get_many", 2), ("cache_set_many", 2), ("get_lists", 3)], self.store.store.calls)
+
+    async def test_other_methods(self):
+        batch = [method_request("online_score_batch", {"profiles": PROFILES[:2]}), {"login": "h&f"}]
+        response, code = await async_api.batch_handler({"body": batch}, {"request_id": "1"}, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([api.OK, api.INVALID_REQUEST], [item["code"] for item in response])
+
+    async def test_invalid_batch(self):
+        for body in ([], list(range(api.MAX_BATCH_REQUESTS + 1)), {}):
+            _, code = await async_api.batch_handler({"body": body}, {"request_id": "1"}, self.store)
+            self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class TestOnlineScoreBatch(unittest.TestCase):
+    def setUp(self):
+        self.store = CountingStore()
+        self.context = {}
+
+    def get_response(self, request):
+        return api.method_handler(request, self.context, self.store)
+
+    def test_scores_and_errors(self):
+        response, code = self.get_response(make_request(PROFILES))
+        self.assertEqual(api.OK, code)
+        self.assertEqual(len(PROFILES), self.context["nprofiles"])
+        self.assertEqual([api.OK, api.INVALID_REQUEST, api.INVALID_REQUEST, api.OK, api.OK, api.OK, api.OK],
+                         [item["code"] for item in response])
+        self.assertEqual(["Required pairs don't exist"], response[1]["error"])
+        self.assertEqual(["Profile must be an object"], response[2]["error"])
+        body = dict(make_request(None)["body"], method="online_score")
+        single = [api.online_score_handler({"body": dict(body, arguments=profile)}, {}, store.MemoryStore())
+                  for profile in PROFILES if isinstance(profile, dict)]
+        self.assertEqual([r["score"] for r, c in single if c == api.OK],
+                         [item["response"]["score"] for item in response if item["code"] == api.OK])
+
+    def test_one_read_and_one_write(self):
+        self.get_response(make_request(PROFILES))
+        # the duplicate profile is calculated and written once
+        self.assertEqual([("cache_get_many", 5), ("cache_set_many", 4)], self.store.calls)
+        self.store.calls = []
+        response, _ = self.get_response(make_request(PROFILES))
+        self.assertEqual([("cache_get_many", 5)], self.store.calls)
+        self.assertEqual(0.0, response[5]["response"]["score"])
+
+    def test_admin(self):
+        response, code = self.get_response(make_request(PROFILES[:2], login=api.ADMIN_LOGIN))
+        self.assertEqual(api.OK, code)
+        self.assertEqual([{"response": {"score": 42}, "code": api.OK},
+                          {"error": ["Required pairs don't exist"], "code": api.INVALID_REQUEST}], response)
+        self.assertEqual([], self.store.calls)
+
+    def test_bad_auth(self):
+        request = make_request(PROFILES)
+        request["body"]["token"] = ""
+        _, code = self.get_response(request)
+        self.assertEqual(api.FORBIDDEN, code)
+
+    @cases([
+        None,
+        [],
+        {"phone": "79175002040"},
+        [{}] * (api.MAX_BATCH_PROFILES + 1),
+    ])
+    def test_invalid_profiles(self, profiles):
+        response, code = self.get_response(make_request(profiles))
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertTrue(len(response))
+
+    def test_calculate_scores(self):
+        rows = [
+            ("79175002040", "a@b.ru", None, None, None, None),
+            (None, None, "01.01.2000", 1, "a", "b"),
+            (None, None, "01.01.2000", 0, None, None),
+            (None, None, None, None, None, None),
+        ]
+        self.assertEqual([scoring.calculate_score(*row) for row in rows],
+                         scoring.calculate_scores(*zip(*rows)))
+
+
+class TestAsyncOnlineScoreBatch(unittest.IsolatedAsyncioTestCase):
+    async def test_scores_and_errors(self):
+        s = store.AsyncMemoryStore()
+        response, code = await async_api.method_handler(make_request(PROFILES), {}, s)
+        self.assertEqual(api.OK, code)
+        expected, _ = api.method_handler(make_request(PROFILES), {}, store.MemoryStore())
+        self.assertEqual(expected, response)
+
+
+if __name__ == "__main__":
+    unittest.main()
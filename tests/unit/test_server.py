@@ -0,0 +1,484 @@
+import datetime
+import hashlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.client import HTTPConnection
+
+from scoring_api import api
+from scoring_api import profiling
+from scoring_api import store
+from tests.case_decorator import cases
+
+
+class TestThreadPoolHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.server = api.make_server(("localhost", 0), threads=4)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def post(self, path, body):
+        conn = HTTPConnection(*self.server.server_address, timeout=5)
+        try:
+            conn.request("POST", path, json.dumps(body),
+                         {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            conn.close()
+
+    def test_server_is_thread_pool(self):
+        self.assertIsInstance(self.server, api.ThreadPoolHTTPServer)
+
+    def test_concurrent_requests(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        results = []
+
+        def worker():
+            results.append(self.post("/method/", request))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8, len(results))
+        for status, body in results:
+            self.assertEqual(api.FORBIDDEN, status)
+            self.assertEqual(api.FORBIDDEN, body["code"])
+
+    def test_batch(self):
+        admin_token = hashlib.sha512(
+            (datetime.datetime.now().strftime("%Y%m%d%H")
+             + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+        batch = [
+            {"account": "horns&hoofs", "login": "admin", "token": admin_token,
+             "method": "online_score", "arguments": {"first_name": "a", "last_name": "b"}},
+            {"account": "horns&hoofs", "login": "h&f", "token": "",
+             "method": "online_score", "arguments": {}},
+            {"login": "h&f", "arguments": {}},
+            "not a request",
+        ]
+        status, body = self.post("/batch/", batch)
+        self.assertEqual(api.OK, status)
+        self.assertEqual([
+            {"response": {"score": 42}, "code": api.OK},
+            {"error": "Forbidden", "code": api.FORBIDDEN},
+            {"error": ["Unknown method"], "code": api.INVALID_REQUEST},
+            {"error": ["Method request must be an object"], "code": api.INVALID_REQUEST},
+        ], body["response"])
+
+    def test_batch_not_list(self):
+        status, body = self.post("/batch/", {"method": "online_score"})
+        self.assertEqual(api.INVALID_REQUEST, status)
+
+    def test_empty_batch(self):
+        status, body = self.post("/batch/", [])
+        self.assertEqual(api.INVALID_REQUEST, status)
+        self.assertEqual(["Batch is empty"], body["error"])
+
+    def test_metrics(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        self.post("/method/", request)
+        self.post("/method/", dict(request, method="no_such_method"))
+        conn = HTTPConnection(*self.server.server_address, timeout=5)
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        text = response.read().decode()
+        conn.close()
+        self.assertEqual(api.OK, response.status)
+        self.assertTrue(response.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn('scoring_requests_total{method="online_score",code="403"}', text)
+        self.assertIn('scoring_requests_total{method="unknown",code="500"}', text)
+        self.assertIn('scoring_request_duration_seconds_bucket{method="online_score",code="403",le="+Inf"}', text)
+        self.assertIn("# TYPE scoring_requests_in_flight gauge", text)
+
+    def test_unknown_path(self):
+        status, _ = self.post("/unknown/", {"method": "online_score"})
+        self.assertEqual(api.NOT_FOUND, status)
+
+    def test_profile_route(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "dump",
+                   "token": api.user_digest("horns&hoofs", "h&f"), "arguments": {}}
+        status, _ = self.post("/profile/", request)
+        self.assertEqual(api.FORBIDDEN, status)
+
+        admin = dict(request, login=api.ADMIN_LOGIN, token=api.admin_digest(datetime.datetime.now()))
+        status, _ = self.post("/profile/", admin)
+        self.assertEqual(api.INVALID_REQUEST, status)
+
+        with tempfile.TemporaryDirectory() as directory:
+            api.PROFILER = profiling.Profiler(directory, rate=1)
+            try:
+                self.post("/method/", dict(request, method="online_score"))
+                status, body = self.post("/profile/", admin)
+            finally:
+                api.PROFILER = None
+            self.assertEqual(api.OK, status)
+            [path] = body["response"]["files"]
+            self.assertTrue(os.path.basename(path).startswith("online_score-"))
+            self.assertTrue(os.path.exists(path))
+
+    def test_clients_interests(self):
+        saved, api.STORE = api.STORE, store.MemoryStore()
+        api.STORE.set_list(1, ["Sport", "Кино"])
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "token": api.user_digest("horns&hoofs", "h&f"),
+                   "arguments": {"client_ids": [1, 2], "date": "19.07.2017"}}
+        try:
+            status, body = self.post("/method/", request)
+        finally:
+            api.STORE = saved
+        self.assertEqual(api.OK, status)
+        self.assertEqual({"response": {"1": ["Sport", "Кино"], "2": []}, "code": api.OK}, body)
+
+    def test_streamed_interests(self):
+        saved, api.STORE = api.STORE, store.MemoryStore()
+        for cid in range(0, 1200, 2):
+            api.STORE.set_list(cid, ["interest%d" % cid, "books"])
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "token": "",
+                   "arguments": {"client_ids": list(range(1200)) + [2]}}
+        try:
+            conn = HTTPConnection(*self.server.server_address, timeout=5)
+            conn.request("POST", "/method/", json.dumps(request))
+            response = conn.getresponse()
+            expected = response.read()
+            conn.request("POST", "/method/", json.dumps(request), {"X-Stream": "1"})
+            response = conn.getresponse()
+            streamed = response.read()
+            self.assertEqual("chunked", response.getheader("Transfer-Encoding"))
+            self.assertIsNone(response.getheader("Content-Length"))
+            # the connection is still usable after the stream
+            conn.request("POST", "/method/", json.dumps(dict(request, method="online_score")))
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+        finally:
+            api.STORE = saved
+        self.assertEqual(json.loads(expected), json.loads(streamed))
+        self.assertEqual(["interest2", "books"], json.loads(streamed)["response"]["2"])
+        self.assertEqual(api.FORBIDDEN, response.status)
+
+    def test_stream_needs_http11(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "token": "",
+                   "arguments": {"client_ids": [1]}}
+        data = json.dumps(request).encode()
+        sock = socket.create_connection(self.server.server_address, timeout=5)
+        sock.sendall(b"POST /method/ HTTP/1.0\r\nX-Stream: 1\r\nContent-Length: %d\r\n\r\n%s" % (len(data), data))
+        response = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+        sock.close()
+        self.assertIn(b"Content-Length", response)
+        self.assertNotIn(b"chunked", response)
+
+    def test_interests_json_chunks(self):
+        chunks = [[(1, ["a"]), (2, [])], [], [(3, ["b", "c"])]]
+        scores = {1: ["a"], 2: [], 3: ["b", "c"]}
+        self.assertEqual(json.dumps(api.build_response(scores, api.OK)),
+                         "".join(api.interests_json_chunks(chunks)))
+        self.assertEqual(json.dumps(api.build_response({}, api.OK)), "".join(api.interests_json_chunks([])))
+
+    def test_server_timing(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        conn = HTTPConnection(*self.server.server_address, timeout=5)
+        conn.request("POST", "/method/", json.dumps(request))
+        response = conn.getresponse()
+        response.read()
+        self.assertIsNone(response.getheader("Server-Timing"))
+        conn.request("POST", "/method/", json.dumps(request), {"X-Debug-Timing": "1"})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        phases = [part.split(";")[0] for part in response.getheader("Server-Timing").split(", ")]
+        for phase in ("read", "decode", "validation", "auth", "serialize", "total"):
+            self.assertIn(phase, phases)
+
+
+class TestKeepAlive(unittest.TestCase):
+    request = {"account": "horns&hoofs", "login": "h&f",
+               "method": "online_score", "token": "", "arguments": {}}
+
+    def setUp(self):
+        self.server = api.make_server(("localhost", 0), threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_requests_over_one_connection(self):
+        conn = HTTPConnection(*self.server.server_address, timeout=5)
+        sockets = set()
+        for _ in range(5):
+            conn.request("POST", "/method/", json.dumps(self.request))
+            response = conn.getresponse()
+            sockets.add(id(conn.sock))
+            self.assertEqual(api.FORBIDDEN, response.status)
+            self.assertEqual(api.FORBIDDEN, json.loads(response.read())["code"])
+            self.assertFalse(response.will_close)
+        conn.close()
+        self.assertEqual(1, len(sockets))
+
+    def test_pipelined_requests(self):
+        body = json.dumps(self.request).encode()
+        raw = (b"POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n"
+               % len(body)) + body
+        with socket.create_connection(self.server.server_address,
+                                      timeout=5) as sock:
+            sock.sendall(raw * 3)
+            stream = sock.makefile("rb")
+            for _ in range(3):
+                self.assertIn(b" 403 ", stream.readline())
+                length = 0
+                while True:
+                    line = stream.readline().strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(b":")
+                    if name.lower() == b"content-length":
+                        length = int(value)
+                body = json.loads(stream.read(length))
+                self.assertEqual(api.FORBIDDEN, body["code"])
+
+    def test_max_requests_per_connection(self):
+        limit = api.MainHTTPHandler.max_keepalive_requests
+        api.MainHTTPHandler.max_keepalive_requests = 2
+        try:
+            conn = HTTPConnection(*self.server.server_address, timeout=5)
+            conn.request("POST", "/method/", json.dumps(self.request))
+            response = conn.getresponse()
+            response.read()
+            self.assertFalse(response.will_close)
+            conn.request("POST", "/method/", json.dumps(self.request))
+            response = conn.getresponse()
+            response.read()
+            self.assertTrue(response.will_close)
+            conn.close()
+        finally:
+            api.MainHTTPHandler.max_keepalive_requests = limit
+
+    def assert_served_past_idle_connections(self, server, idle):
+        connections = []
+        try:
+            for _ in range(idle):
+                conn = HTTPConnection(*server.server_address, timeout=5)
+                conn.request("POST", "/method/", json.dumps(self.request))
+                conn.getresponse().read()
+                connections.append(conn)
+            started = time.monotonic()
+            conn = HTTPConnection(*server.server_address, timeout=5)
+            conn.request("POST", "/method/", json.dumps(self.request))
+            self.assertEqual(api.FORBIDDEN, conn.getresponse().status)
+            conn.close()
+            self.assertLess(time.monotonic() - started, 1)
+        finally:
+            for conn in connections:
+                conn.close()
+
+    def test_idle_connections_give_way(self):
+        # more idle keep-alive clients than workers
+        self.assert_served_past_idle_connections(self.server, 4)
+
+    def test_idle_connection_gives_way_in_single_mode(self):
+        server = api.make_server(("localhost", 0), threads=1)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.assert_served_past_idle_connections(server, 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class TestRequestBody(unittest.TestCase):
+    request = {"account": "horns&hoofs", "login": "h&f",
+               "method": "online_score", "token": "", "arguments": {}}
+
+    def setUp(self):
+        self.server = api.make_server(("localhost", 0), threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.sock = socket.create_connection(self.server.server_address, timeout=5)
+
+    def tearDown(self):
+        self.sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def reconnect(self):
+        # every case of a @cases test needs a fresh connection
+        self.sock.close()
+        self.sock = socket.create_connection(self.server.server_address, timeout=5)
+
+    def read_response(self):
+        # (status, body) of a response the server closes the connection after
+        data = b""
+        while True:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        head, _, body = data.partition(b"\r\n\r\n")
+        return int(head.split()[1]), json.loads(body)
+
+    def test_too_large(self):
+        self.sock.sendall(b"POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (api.MAX_BODY_SIZE + 1))
+        status, body = self.read_response()
+        self.assertEqual(api.REQUEST_TOO_LARGE, status)
+        self.assertEqual({"error": "Payload Too Large", "code": api.REQUEST_TOO_LARGE}, body)
+
+    @cases([
+        b"POST /method/ HTTP/1.1\r\n\r\n",
+        b"POST /method/ HTTP/1.1\r\nContent-Length: x\r\n\r\n",
+        b"POST /method/ HTTP/1.1\r\nContent-Length: -1\r\n\r\n",
+    ])
+    def test_bad_length(self, head):
+        self.reconnect()
+        self.sock.sendall(head)
+        status, _ = self.read_response()
+        self.assertEqual(api.BAD_REQUEST, status)
+
+    def test_truncated_body(self):
+        self.sock.sendall(b"POST /method/ HTTP/1.1\r\nContent-Length: 100\r\n\r\n{}")
+        self.sock.shutdown(socket.SHUT_WR)
+        status, _ = self.read_response()
+        self.assertEqual(api.BAD_REQUEST, status)
+
+    def test_slow_body(self):
+        timeout = api.MainHTTPHandler.body_timeout
+        api.MainHTTPHandler.body_timeout = 0.3
+        try:
+            data = json.dumps(self.request).encode()
+            self.sock.sendall(b"POST /method/ HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(data))
+            started = time.monotonic()
+            # each byte comes well within the timeout, the body doesn't
+            for byte in data:
+                try:
+                    self.sock.sendall(bytes([byte]))
+                except OSError:
+                    break
+                time.sleep(0.05)
+            status, _ = self.read_response()
+        finally:
+            api.MainHTTPHandler.body_timeout = timeout
+        self.assertEqual(api.REQUEST_TIMEOUT, status)
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_body_in_pieces(self):
+        data = json.dumps(self.request).encode()
+        self.sock.sendall(b"POST /method/ HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n" % len(data))
+        for i in range(0, len(data), 16):
+            self.sock.sendall(data[i:i + 16])
+            time.sleep(0.01)
+        status, body = self.read_response()
+        self.assertEqual(api.FORBIDDEN, status)
+
+    @cases([
+        {"client_ids": []},
+        {"client_ids": list(range(api.MAX_CLIENT_IDS + 1))},
+    ])
+    def test_invalid_interests(self, arguments):
+        request = dict(self.request, method="clients_interests", arguments=arguments)
+        data = json.dumps(request).encode()
+        self.reconnect()
+        self.sock.sendall(b"POST /method/ HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n%s"
+                          % (len(data), data))
+        status, body = self.read_response()
+        self.assertEqual(api.INVALID_REQUEST, status)
+        self.assertEqual(1, len(body["error"]))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@unittest.skipUnless(os.path.exists("/proc/self/task"), "needs /proc")
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.master = subprocess.Popen(
+            [sys.executable, "-m", "scoring_api.api", "--mode", "prefork", "--workers", "2",
+             "--threads", "2", "--store", "memory", "--port", str(self.port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(self.master.kill)
+        self.addCleanup(self.master.wait)
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+    def workers(self):
+        path = "/proc/%d/task/%d/children" % (self.master.pid, self.master.pid)
+        with open(path) as children:
+            return set(int(pid) for pid in children.read().split())
+
+    def post(self):
+        request = {"account": "horns&hoofs", "login": "h&f",
+                   "method": "online_score", "token": "", "arguments": {}}
+        conn = HTTPConnection("localhost", self.port, timeout=5)
+        try:
+            conn.request("POST", "/method/", json.dumps(request))
+            return conn.getresponse().status
+        except OSError:
+            return None
+        finally:
+            conn.close()
+
+    def test_serves_and_stops_on_sigterm(self):
+        self.wait_for(lambda: self.post() is not None)
+        self.assertEqual(api.FORBIDDEN, self.post())
+        # the scrape goes to the worker that served the request
+        conn = HTTPConnection("localhost", self.port, timeout=5)
+        conn.request("POST", "/method/", json.dumps({"method": "online_score"}))
+        conn.getresponse().read()
+        conn.request("GET", "/metrics")
+        text = conn.getresponse().read().decode()
+        conn.close()
+        pids = "|".join(str(pid) for pid in self.workers())
+        self.assertRegex(text, r'scoring_requests_total\{method="online_score",code="\d+",pid="(%s)"\} ' % pids)
+        self.master.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self.master.wait(timeout=10))
+        self.assertIsNone(self.post())
+
+    def test_dead_worker_is_replaced(self):
+        self.wait_for(lambda: len(self.workers()) == 2)
+        workers = self.workers()
+        dead = workers.pop()
+        os.kill(dead, signal.SIGKILL)
+        self.wait_for(lambda: len(self.workers()) == 2 and dead not in self.workers())
+        self.assertTrue(workers < self.workers())
+        self.wait_for(lambda: self.post() is not None)
+        self.assertEqual(api.FORBIDDEN, self.post())
+        self.master.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self.master.wait(timeout=10))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from scoring_api import scoring
+from scoring_api import store
+from scoring_api.singleflight import AsyncSingleFlight, SingleFlight
+
+
+class SlowStore(store.MemoryStore):
+    # counts cache writes and makes them slow enough for callers to pile up
+    def __init__(self):
+        super(SlowStore, self).__init__()
+        self.writes = 0
+
+    def cache_set(self, key, value, expire_timeout):
+        self.writes += 1
+        time.sleep(0.05)
+        super(SlowStore, self).cache_set(key, value, expire_timeout)
+
+
+class AsyncSlowStore(store.AsyncMemoryStore):
+    def __init__(self):
+        super(AsyncSlowStore, self).__init__()
+        self.writes = 0
+
+    async def cache_set(self, key, value, expire_timeout):
+        self.writes += 1
+        await asyncio.sleep(0.05)
+        await super(AsyncSlowStore, self).cache_set(key, value, expire_timeout)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def test_concurrent_calls_share_result(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 42
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", compute)))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([42] * 8, [result for result, _ in results])
+        self.assertEqual(7, sum(shared for _, shared in results))
+        self.assertEqual({}, flight.calls)
+
+    def test_error_is_shared(self):
+        flight = SingleFlight()
+        errors = []
+
+        def compute():
+            time.sleep(0.05)
+            raise ValueError("boom")
+
+        def call():
+            try:
+                flight.do("key", compute)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(errors))
+        self.assertEqual((1, False), flight.do("key", lambda: 1))
+
+    def test_get_score_coalesces(self):
+        s = SlowStore()
+        scores = []
+        threads = [threading.Thread(target=lambda: scores.append(
+            scoring.get_score(s, "79175002040", "stupnikov@otus.ru"))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([3.0] * 8, scores)
+        self.assertEqual(1, s.writes)
+
+    def test_cached_zero_score(self):
+        s = SlowStore()
+        self.assertEqual(0, scoring.get_score(s, None, None))
+        self.assertEqual(0.0, scoring.get_score(s, None, None))
+        self.assertEqual(1, s.writes)
+
+
+class TestAsyncSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_share_result(self):
+        flight = AsyncSingleFlight()
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return 42
+
+        results = await asyncio.gather(*[flight.do("key", compute) for _ in range(8)])
+        self.assertEqual(1, len(calls))
+        self.assertEqual([(42, False)] + [(42, True)] * 7, results)
+        self.assertEqual({}, flight.calls)
+
+    async def test_error_is_shared(self):
+        flight = AsyncSingleFlight()
+
+        async def compute():
+            await asyncio.sleep(0.05)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(*[flight.do("key", compute) for _ in range(3)], return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual({}, flight.calls)
+
+    async def test_get_score_coalesces(self):
+        s = AsyncSlowStore()
+        scores = await asyncio.gather(*[scoring.get_score_async(s, "79175002040", "stupnikov@otus.ru")
+                                        for _ in range(8)])
+        self.assertEqual([3.0] * 8, scores)
+        self.assertEqual(1, s.writes)
+        self.assertEqual(0.0, await scoring.get_score_async(s, None, None))
+        self.assertEqual(0.0, await scoring.get_score_async(s, None, None))
+        self.assertEqual(2, s.writes)
+
+
+if __name__ == "__main__":
+    unittest.main()
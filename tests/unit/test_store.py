@@ -0,0 +1,441 @@
+import asyncio
+import time
+import unittest
+
+from scoring_api import api
+from scoring_api import scoring
+from scoring_api import store
+
+# nothing listens here, so every Redis command fails with a connection error
+DEAD_REDIS_CONFIG = dict(api.REDIS_CONFIG, port=1)
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_blocking_pool(self):
+        s = store.Store(api.REDIS_CONFIG, {"blocking_pool": True, "pool_timeout": 1})
+        self.assertIsInstance(s.connection_pool, store.StatsBlockingConnectionPool)
+        self.assertEqual(api.REDIS_CONFIG["max_connections"], s.connection_pool.max_connections)
+        self.assertEqual(1, s.connection_pool.timeout)
+
+    def test_default_pool(self):
+        s = store.Store(api.REDIS_CONFIG, {})
+        self.assertIsInstance(s.connection_pool, store.StatsConnectionPool)
+
+    def test_pool_stats(self):
+        for custom_config in ({}, {"blocking_pool": True}):
+            s = store.Store(api.REDIS_CONFIG, custom_config)
+            stats = s.pool_stats()
+            self.assertEqual(0, stats["in_use"])
+            self.assertEqual(0, stats["idle"])
+            self.assertEqual(0, stats["acquired"])
+            self.assertEqual(0.0, stats["avg_wait_ms"])
+            self.assertEqual(api.REDIS_CONFIG["max_connections"], stats["max_connections"])
+
+    def test_blocking_pool_counts(self):
+        s = store.Store(api.REDIS_CONFIG, {"blocking_pool": True})
+        # take a free slot the way get_connection does, without connecting
+        s.connection_pool.pool.get_nowait()
+        connection = s.connection_pool.make_connection()
+        self.assertEqual((1, 0), s.connection_pool.connection_counts())
+        s.connection_pool.release(connection)
+        self.assertEqual((0, 1), s.connection_pool.connection_counts())
+
+
+class TestLocalCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = store.LocalCache(max_size=2)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", b"1.5", 60)
+        self.assertEqual(b"1.5", self.cache.get("a"))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+
+    def test_lru_eviction(self):
+        self.cache.set("a", 1, 60)
+        self.cache.set("b", 2, 60)
+        self.cache.get("a")
+        self.cache.set("c", 3, 60)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(3, self.cache.get("c"))
+        self.assertEqual(1, self.cache.stats()["evictions"])
+
+    def test_expiry(self):
+        self.cache.set("a", 1, 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(0, self.cache.stats()["size"])
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(store.Store(api.REDIS_CONFIG, {}).local_cache)
+        self.assertIsNotNone(store.Store(api.REDIS_CONFIG, {"local_cache_size": 10}).local_cache)
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.queue = store.WriteBehindQueue(self.batches.append, max_size=3, batch_size=2, interval=0.01)
+
+    def test_flush_on_close(self):
+        for i in range(3):
+            self.assertTrue(self.queue.put("key%d" % i, i, 60))
+        self.queue.close()
+        written = [item for batch in self.batches for item in batch]
+        self.assertEqual([("key0", 0, 60), ("key1", 1, 60), ("key2", 2, 60)], sorted(written))
+        self.assertTrue(all(len(batch) <= 2 for batch in self.batches))
+        self.assertFalse(self.queue.put("key3", 3, 60))
+
+    def test_coalesce_and_drop(self):
+        with self.queue.condition:
+            # hold the lock so the flusher can't drain the queue meanwhile
+            self.queue.pending.update({"a": (1, 60), "b": (2, 60), "c": (3, 60)})
+        self.assertTrue(self.queue.put("a", 10, 60))
+        self.assertFalse(self.queue.put("d", 4, 60))
+        self.queue.close()
+        written = dict((key, value) for batch in self.batches for key, value, _ in batch)
+        self.assertEqual({"a": 10, "b": 2, "c": 3}, written)
+        stats = self.queue.stats()
+        self.assertEqual(1, stats["coalesced"])
+        self.assertEqual(1, stats["dropped"])
+        self.assertEqual(0, stats["pending"])
+
+
+class TestInterestsCache(unittest.TestCase):
+    def setUp(self):
+        # the listener thread isn't started, messages are handed in directly
+        self.cache = store.InterestsCache(api.REDIS_CONFIG, max_size=10, ttl=60)
+        self.cache.thread = False
+
+    def subscribe(self):
+        self.cache.handle({"type": "psubscribe", "channel": b"__keyspace@0__:[0-9]*", "data": 1})
+
+    def fill(self, keys, values):
+        self.cache.finish(self.cache.begin(), keys, values)
+
+    def test_not_cached_until_subscribed(self):
+        self.fill([b"1"], [[b"Sport"]])
+        self.assertEqual([None], self.cache.lookup([b"1"]))
+        self.subscribe()
+        self.fill([b"1"], [[b"Sport"]])
+        self.assertEqual([[b"Sport"]], self.cache.lookup([b"1"]))
+
+    def test_keyspace_notification_invalidates(self):
+        self.subscribe()
+        self.fill([b"1", b"-2"], [[b"Sport"], []])
+        self.cache.handle({"type": "pmessage", "pattern": b"__keyspace@0__:[0-9]*",
+                           "channel": b"__keyspace@0__:1", "data": b"rpush"})
+        self.assertEqual([None, []], self.cache.lookup([b"1", b"-2"]))
+        self.assertEqual(1, self.cache.stats()["invalidations"])
+
+    def test_only_client_ids_are_cached(self):
+        self.subscribe()
+        self.fill([b"uid:1", b"i:1", b"-", b"12"], [[b"1"], [b"2"], [b"3"], [b"4"]])
+        self.assertEqual([None, None, None, [b"4"]], self.cache.lookup([b"uid:1", b"i:1", b"-", b"12"]))
+
+    def test_fetch_overlapping_a_write_skips_that_key(self):
+        self.subscribe()
+        token = self.cache.begin()
+        self.cache.invalidate(b"2")
+        self.cache.finish(token, [b"1", b"2"], [[b"Sport"], [b"Books"]])
+        self.assertEqual([[b"Sport"], None], self.cache.lookup([b"1", b"2"]))
+        self.assertEqual({}, self.cache.written)
+
+    def test_fetch_overlapping_a_reset_is_not_cached(self):
+        self.subscribe()
+        token = self.cache.begin()
+        self.cache.reset(False)
+        self.subscribe()
+        self.cache.finish(token, [b"1"], [[b"Sport"]])
+        self.assertEqual([None], self.cache.lookup([b"1"]))
+
+    def test_failed_fetch(self):
+        self.subscribe()
+        self.cache.finish(self.cache.begin(), [b"1"], None)
+        self.assertEqual(0, self.cache.fetches)
+        self.assertEqual([None], self.cache.lookup([b"1"]))
+
+    def test_cleared_when_subscription_drops(self):
+        self.subscribe()
+        self.fill([b"1"], [[b"Sport"]])
+        self.cache.reset(False)
+        self.assertEqual([None], self.cache.lookup([b"1"]))
+        stats = self.cache.stats()
+        self.assertFalse(stats["listening"])
+        self.assertEqual(0, stats["size"])
+
+    def test_fallback_ttl(self):
+        self.cache.ttl = 0.01
+        self.subscribe()
+        self.fill([b"1"], [[b"Sport"]])
+        time.sleep(0.02)
+        self.assertEqual([None], self.cache.lookup([b"1"]))
+
+    def test_notifications_fail_closed(self):
+        class Client(object):
+            def __init__(self, flags=None):
+                self.flags = flags
+                self.set_to = None
+
+            def config_get(self, name):
+                if self.flags is None:
+                    raise store.redis.ResponseError("unknown command 'CONFIG'")
+                return {name: self.flags}
+
+            def config_set(self, name, value):
+                self.set_to = value
+
+        self.assertFalse(self.cache.enable_notifications(Client()))
+        self.assertFalse(self.cache.enable_notifications(Client(b"")))
+        self.assertTrue(self.cache.enable_notifications(Client(b"AKE")))
+        self.assertTrue(self.cache.enable_notifications(Client(b"Kg$lxe")))
+        self.cache.configure = True
+        client = Client(b"Ex")
+        self.assertTrue(self.cache.enable_notifications(client))
+        self.assertEqual("AEKx", client.set_to)
+        self.cache.configured = True
+        self.assertTrue(self.cache.enable_notifications(Client()))
+
+    def test_store_serves_cached_lists(self):
+        s = store.Store(DEAD_REDIS_CONFIG, {"interests_cache_size": 10, "reconnect_attempts": 1})
+        s.interests_cache = self.cache
+        self.subscribe()
+        self.fill([b"1"], [[b"Sport"]])
+        self.assertEqual([b"Sport"], s.get_list(1))
+        self.assertEqual([[b"Sport"]], s.get_lists(["1"]))
+        self.assertIsNone(s.get_lists(["1", "2"]))
+        self.assertEqual(0, self.cache.fetches)
+        s.set_list("1", ["Books"])
+        self.assertEqual([None], self.cache.lookup([b"1"]))
+
+    def test_disabled_by_default(self):
+        s = store.Store(api.REDIS_CONFIG, api.REDIS_CUSTOM_CONFIG)
+        self.assertIsNone(s.interests_cache)
+        self.assertIsNone(s.interests_cache_stats())
+        cache = store.Store(api.REDIS_CONFIG, {"interests_cache_size": 10}).interests_cache
+        self.assertFalse(cache.configure)
+        self.assertFalse(cache.configured)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_delays(self):
+        policy = store.RetryPolicy(attempts=5, base_delay=0.1, max_delay=0.3)
+        delays = list(policy.delays())
+        self.assertEqual(5, len(delays))
+        self.assertIsNone(delays[-1])
+        for attempt, delay in enumerate(delays[:-1]):
+            self.assertTrue(0 <= delay <= min(0.3, 0.1 * 2 ** attempt))
+
+    def test_single_attempt(self):
+        self.assertEqual([None], list(store.RetryPolicy(attempts=1).delays()))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_threshold(self):
+        breaker = store.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(store.CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_probe(self):
+        breaker = store.CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(store.CircuitBreaker.OPEN, breaker.state)
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(store.CircuitBreaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+
+
+class TestBreakerProbe(unittest.IsolatedAsyncioTestCase):
+    custom_config = {"reconnect_attempts": 1, "breaker_failure_threshold": 1, "breaker_reset_timeout": 0.01}
+
+    def broken(self, *args):
+        raise ValueError("not a Redis error")
+
+    async def async_broken(self, *args):
+        self.broken()
+
+    def test_unexpected_error_in_probe(self):
+        s = store.Store(DEAD_REDIS_CONFIG, self.custom_config)
+        self.assertIsNone(s.get("key"))
+        time.sleep(0.02)
+        with self.assertRaises(ValueError):
+            s._call("get", "Cannot get value from Redis", self.broken)
+        self.assertEqual(store.CircuitBreaker.OPEN, s.breaker.state)
+        time.sleep(0.02)
+        self.assertTrue(s.breaker.allow())
+
+    async def test_unexpected_error_in_async_probe(self):
+        s = store.AsyncStore(DEAD_REDIS_CONFIG, self.custom_config)
+        self.assertIsNone(await s.get("key"))
+        await asyncio.sleep(0.02)
+        with self.assertRaises(ValueError):
+            await s._call("get", "Cannot get value from Redis", self.async_broken)
+        self.assertEqual(store.CircuitBreaker.OPEN, s.breaker.state)
+        await asyncio.sleep(0.02)
+        self.assertTrue(s.breaker.allow())
+        await s.close()
+
+    def test_unexpected_errors_leave_closed_breaker_alone(self):
+        s = store.Store(DEAD_REDIS_CONFIG, dict(self.custom_config, breaker_failure_threshold=2))
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                s._call("get", "Cannot get value from Redis", self.broken)
+        self.assertEqual(store.CircuitBreaker.CLOSED, s.breaker.state)
+        self.assertEqual(0, s.breaker.failures)
+
+    async def test_cancelled_call_leaves_closed_breaker_alone(self):
+        s = store.AsyncStore(DEAD_REDIS_CONFIG, self.custom_config)
+        started = asyncio.Event()
+
+        async def hang(*args):
+            started.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(s._call("get", "Cannot get value from Redis", hang))
+        await started.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(store.CircuitBreaker.CLOSED, s.breaker.state)
+        self.assertEqual(0, s.breaker.failures)
+        await s.close()
+
+
+class TestMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.store = store.MemoryStore()
+
+    def test_values_are_encoded(self):
+        self.store.set("uid:1", 3.0)
+        self.store.set_list(1, ["Sport", "Drama"])
+        self.assertEqual(b"3.0", self.store.get("uid:1"))
+        self.assertEqual([b"Sport", b"Drama"], self.store.get_list("1"))
+        self.assertEqual([], self.store.get_list("2"))
+        self.assertIsNone(self.store.get("missing"))
+
+    def test_bulk(self):
+        self.store.set("a", 1)
+        self.store.set_list("b", ["x"])
+        self.assertEqual([b"1", None, None], self.store.get_many(["a", "b", "c"]))
+        self.assertEqual([[], [b"x"], []], self.store.get_lists(["a", "b", "c"]))
+        self.store.cache_set_many([("c", 1.5), ("d", 0)], 60)
+        self.assertEqual([b"1.5", b"0", None], self.store.cache_get_many(["c", "d", "e"]))
+
+    def test_cache_expiry(self):
+        self.store.cache_set("a", 1.5, 0.01)
+        self.assertEqual(b"1.5", self.store.cache_get("a"))
+        time.sleep(0.02)
+        self.assertIsNone(self.store.cache_get("a"))
+        self.assertEqual({}, self.store.items)
+
+    def test_sweep_expired(self):
+        self.store.cache_set_many([("key%d" % i, i) for i in range(1000)], 0.01)
+        time.sleep(0.02)
+        self.store.cache_set_many([("other%d" % i, i) for i in range(100)], 60)
+        self.assertEqual(100, len(self.store.items))
+
+    def test_handlers(self):
+        self.store.set_list(1, ["Sport"])
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "token": api.user_digest("horns&hoofs", "h&f"), "arguments": {"client_ids": [1, 2]}}
+        response, code = api.method_handler({"body": request}, {}, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual({1: ["Sport"], 2: []}, response)
+        self.assertEqual(3.0, scoring.get_score(self.store, "79175002040", "stupnikov@otus.ru"))
+        key = scoring.get_score_key("79175002040")
+        self.assertEqual(b"3.0", self.store.cache_get(key))
+
+    def test_make_store(self):
+        self.assertIsInstance(store.make_store("memory", api.REDIS_CONFIG, {}), store.MemoryStore)
+        self.assertIsInstance(store.make_store("redis", api.REDIS_CONFIG, {}), store.Store)
+        self.assertIsInstance(store.make_store("memory", api.REDIS_CONFIG, {}, asynchronous=True),
+                              store.AsyncMemoryStore)
+        for name in store.STORES:
+            for custom_config in ({}, {"batch_window": 0.001}):
+                self.assertIsInstance(store.make_store(name, api.REDIS_CONFIG, custom_config), store.BaseStore)
+                self.assertIsInstance(store.make_store(name, api.REDIS_CONFIG, custom_config, asynchronous=True),
+                                      store.AsyncBaseStore)
+
+    def test_incomplete_backend(self):
+        class NoLists(store.BaseStore):
+            def get(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            NoLists()
+
+    def test_pool_connections_without_pool(self):
+        saved, api.STORE = api.STORE, self.store
+        try:
+            self.assertEqual({}, api.store_pool_connections())
+        finally:
+            api.STORE = saved
+
+
+class TestAsyncMemoryStore(unittest.IsolatedAsyncioTestCase):
+    async def test_interests_and_score(self):
+        s = store.AsyncMemoryStore()
+        await s.set_list("1", ["Sport"])
+        self.assertEqual([["Sport"], []], await scoring.get_interests_bulk_async(s, ["1", "2"]))
+        self.assertEqual(3.0, await scoring.get_score_async(s, "79175002040", "stupnikov@otus.ru"))
+        self.assertEqual([b"3.0"], await s.cache_get_many([scoring.get_score_key("79175002040")]))
+
+
+class TestStoreOutage(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store(DEAD_REDIS_CONFIG, {
+            "reconnect_attempts": 3,
+            "retry_base_delay": 0.01,
+            "retry_deadline": 0.5,
+            "breaker_failure_threshold": 3,
+            "breaker_reset_timeout": 60,
+            "local_cache_size": 10,
+        })
+
+    def test_get_gives_up_within_deadline(self):
+        started = time.monotonic()
+        self.assertIsNone(self.store.get("key"))
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_breaker_fails_fast(self):
+        self.store.get_list("key")
+        self.assertEqual(store.CircuitBreaker.OPEN, self.store.breaker.state)
+        started = time.monotonic()
+        for _ in range(100):
+            self.assertIsNone(self.store.get_lists(["1", "2"]))
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    def test_bulk_without_redis(self):
+        self.assertIsNone(self.store.get_many(["1", "2"]))
+        self.assertEqual([None, None], self.store.cache_get_many(["1", "2"]))
+        self.store.cache_set_many([("1", 1.5)], 60)
+        self.assertEqual([b"1.5", None], self.store.cache_get_many(["1", "2"]))
+
+    def test_score_without_redis(self):
+        for _ in range(10):
+            score = scoring.get_score(self.store, "79175002040", "stupnikov@otus.ru")
+            self.assertEqual(3.0, score)
+
+    def test_write_behind_without_redis(self):
+        s = store.Store(DEAD_REDIS_CONFIG, {"write_behind": True, "breaker_failure_threshold": 1})
+        started = time.monotonic()
+        for i in range(100):
+            s.cache_set("key%d" % i, 1.5, 60)
+        self.assertLess(time.monotonic() - started, 0.1)
+        s.close()
+        self.assertEqual(0, s.write_behind_stats()["pending"])
+
+
+if __name__ == "__main__":
+    unittest.main()
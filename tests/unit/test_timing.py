@@ -0,0 +1,45 @@
+import unittest
+
+from scoring_api import timing
+
+
+class TestTiming(unittest.TestCase):
+    def test_span_outside_request(self):
+        with timing.span("store"):
+            pass
+
+    def test_spans_accumulate(self):
+        ctx = {}
+        token = timing.start(ctx)
+        try:
+            with timing.span("store"):
+                pass
+            with timing.span("store"):
+                pass
+            with timing.span("scoring"):
+                pass
+        finally:
+            timing.stop(token)
+        self.assertEqual(["store", "scoring"], list(ctx["timings"]))
+        with timing.span("store"):
+            pass
+        self.assertEqual(2, len(ctx["timings"]))
+
+    def test_span_records_on_error(self):
+        ctx = {}
+        token = timing.start(ctx)
+        try:
+            with self.assertRaises(ValueError):
+                with timing.span("store"):
+                    raise ValueError()
+        finally:
+            timing.stop(token)
+        self.assertIn("store", ctx["timings"])
+
+    def test_server_timing(self):
+        self.assertEqual("store;dur=1.500, total;dur=2.000",
+                         timing.server_timing({"store": 0.0015, "total": 0.002}))
+
+
+if __name__ == "__main__":
+    unittest.main()